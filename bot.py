@@ -1,15 +1,22 @@
 import logging
 import asyncio
-from datetime import datetime, timedelta
-from typing import List, Dict, Any, Optional
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, PreCheckoutQueryHandler, filters, ContextTypes
-from telegram.constants import ParseMode
+import signal
+from datetime import datetime, timezone, time
+from typing import List, Dict, Any, Optional, Callable, Coroutine, Set
+from telegram import Update, Chat, Message, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
+from telegram.ext import Application, ApplicationHandlerStop, CommandHandler, MessageHandler, CallbackQueryHandler, PreCheckoutQueryHandler, TypeHandler, filters, ContextTypes
+from telegram.constants import ChatType, ParseMode
 
 from config import Config
 from database import db
-from openrouter import openrouter_client
-from utils import FileProcessor, MessageFormatter
+from openrouter import openrouter_client, CompletionResult
+from compaction import context_compactor
+from dedupe import update_deduplicator
+from routing import model_router
+from ordering import UserOrderedUpdateProcessor
+from outbound import outbound
+from scheduling import model_scheduler, OverloadedError
+from utils import Attachment, FileProcessor, FileTooLargeError, MessageFormatter
 
 # Configure logging
 logging.basicConfig(
@@ -18,15 +25,56 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+INTERRUPTED_MESSAGE = "🔄 Бот перезапускался и не успел обработать ваш файл. Отправьте его ещё раз — запрос не учтён в лимитах."
+OVERLOADED_MESSAGE = "⏳ Сейчас слишком много запросов. Попробуйте ещё раз через минуту — этот запрос не учтён в лимитах."
+
+def install_stop_handlers(stop: asyncio.Event) -> None:
+    """Set the event on SIGINT or SIGTERM"""
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            # Event loops on Windows do not support signal handlers
+            signal.signal(sig, lambda *_: loop.call_soon_threadsafe(stop.set))
+
 class TelegramBot:
-    def __init__(self):
-        self.application = Application.builder().token(Config.TELEGRAM_BOT_TOKEN).build()
+    def __init__(self, polling: bool = True, maintenance: bool = True, shard: int = 0):
+        builder = (
+            Application.builder()
+            .token(Config.TELEGRAM_BOT_TOKEN)
+            .concurrent_updates(UserOrderedUpdateProcessor(256))
+        )
+        if not polling:
+            # Updates are fed into the update queue by a front process
+            builder = builder.updater(None)
+        self.application = builder.build()
         self.file_processor = FileProcessor()
         self.message_formatter = MessageFormatter()
+        self._inflight: Dict[int, asyncio.Task] = {}
+        self._checkpoints: Dict[int, Dict[str, Any]] = {}
+        self._compactions: Set[asyncio.Task] = set()
+        self._draining = False
+        self.shard = shard
         self._setup_handlers()
+        self._setup_jobs(maintenance)
+    
+    async def _post_init(self, application: Application) -> None:
+        """Create network clients once the event loop is running"""
+        await db.initialize()
+        await openrouter_client.start()
+    
+    async def _post_shutdown(self, application: Application) -> None:
+        """Flush pending writes and release network clients"""
+        await db.close()
+        await openrouter_client.close()
     
     def _setup_handlers(self):
         """Setup all bot handlers"""
+        # Ignore updates no handler acts on, then drop redelivered ones, before any database work
+        self.application.add_handler(TypeHandler(Update, self.drop_irrelevant), group=-2)
+        self.application.add_handler(TypeHandler(Update, self.drop_duplicates), group=-1)
+        
         # Command handlers
         self.application.add_handler(CommandHandler("start", self.start_command))
         self.application.add_handler(CommandHandler("profile", self.profile_command))
@@ -38,6 +86,7 @@ class TelegramBot:
         self.application.add_handler(CommandHandler("resetcontext", self.reset_context_command))
         self.application.add_handler(CommandHandler("ask", self.ask_command))
         self.application.add_handler(CommandHandler("search", self.search_command))
+        self.application.add_handler(CommandHandler("cancel", self.cancel_command))
         
         # Message handlers
         self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
@@ -48,13 +97,76 @@ class TelegramBot:
         
         # Payment handlers
         self.application.add_handler(PreCheckoutQueryHandler(self.handle_pre_checkout))
+        self.application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, self.handle_successful_payment))
         
         # Error handler
         self.application.add_error_handler(self.error_handler)
     
+    def _setup_jobs(self, maintenance: bool = True):
+        """Schedule bulk maintenance and telemetry jobs"""
+        job_queue = self.application.job_queue
+        job_queue.run_repeating(
+            self.scheduler_stats_job,
+            interval=Config.SCHEDULER_STATS_INTERVAL_SECONDS,
+            name="scheduler_stats"
+        )
+        if not maintenance:
+            return
+        
+        local_tz = datetime.now().astimezone().tzinfo
+        
+        # Run right at the day boundary, and periodically to catch expirations and missed windows
+        job_queue.run_daily(self.maintenance_job, time(0, 0, tzinfo=local_tz), name="maintenance_daily")
+        job_queue.run_repeating(
+            self.maintenance_job,
+            interval=Config.MAINTENANCE_INTERVAL_SECONDS,
+            first=0,
+            name="maintenance"
+        )
+    
+    async def maintenance_job(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Reset counters, expire subscriptions and purge stale context"""
+        await db.run_maintenance()
+    
+    async def scheduler_stats_job(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Log model queue depth and per-tier wait times"""
+        logger.info(f"Model scheduler: {model_scheduler.snapshot()}")
+    
+    @staticmethod
+    def _is_relevant(update: Update) -> bool:
+        """Decide from the update alone whether any handler will act on it"""
+        message = update.message
+        if message is None:
+            return True
+        if message.successful_payment:
+            return True
+        
+        text = message.text or message.caption or ""
+        if text.startswith("/"):
+            return True
+        if message.text is not None:
+            return message.text in Config.MODEL_NAMES
+        
+        # Files without a command only get an instruction in private chats
+        if message.document or message.photo:
+            return message.chat.type == ChatType.PRIVATE
+        return False
+    
+    async def drop_irrelevant(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Stop handling group chatter and other updates that need no reply"""
+        if not self._is_relevant(update):
+            raise ApplicationHandlerStop
+    
+    async def drop_duplicates(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Stop handling updates that were already delivered"""
+        if await update_deduplicator.is_duplicate(update):
+            logger.info(f"Dropping duplicate update {update.update_id}")
+            raise ApplicationHandlerStop
+    
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle /start command"""
-        await update.message.reply_text(
+        await outbound.reply_text(
+            update.message,
             self.message_formatter.format_welcome_message(),
             parse_mode=ParseMode.MARKDOWN
         )
@@ -65,12 +177,13 @@ class TelegramBot:
         profile = await db.get_user_profile(user_id)
         
         if profile:
-            await update.message.reply_text(
+            await outbound.reply_text(
+                update.message,
                 self.message_formatter.format_profile_message(profile),
                 parse_mode=ParseMode.MARKDOWN
             )
         else:
-            await update.message.reply_text("❌ Ошибка получения профиля")
+            await outbound.reply_text(update.message, "❌ Ошибка получения профиля")
     
     async def upgrade_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle /upgrade command"""
@@ -78,7 +191,7 @@ class TelegramBot:
         user_data = await db.get_user_data(user_id)
         
         if user_data and user_data['tier'] == 'plus':
-            await update.message.reply_text("Вы уже Premium пользователь! 🎉")
+            await outbound.reply_text(update.message, "Вы уже Premium пользователь! 🎉")
             return
         
         # Create invoice for Telegram Stars
@@ -107,7 +220,8 @@ class TelegramBot:
             )])
         
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(
+        await outbound.reply_text(
+            update.message,
             f"🤖 Выберите модель:\n\nТекущая модель: {current_model}",
             reply_markup=reply_markup
         )
@@ -117,18 +231,18 @@ class TelegramBot:
         user_id = update.effective_user.id
         
         if not context.args:
-            await update.message.reply_text("❌ Укажите текст промпта после команды")
+            await outbound.reply_text(update.message, "❌ Укажите текст промпта после команды")
             return
         
         prompt = " ".join(context.args)
         await db.set_system_prompt(user_id, prompt)
-        await update.message.reply_text("✅ Системный промпт обновлён")
+        await outbound.reply_text(update.message, "✅ Системный промпт обновлён")
     
     async def reset_prompt_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle /resetprompt command"""
         user_id = update.effective_user.id
         await db.reset_system_prompt(user_id)
-        await update.message.reply_text("🔄 Системный промпт сброшен")
+        await outbound.reply_text(update.message, "🔄 Системный промпт сброшен")
     
     async def get_prompt_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle /getprompt command"""
@@ -136,32 +250,44 @@ class TelegramBot:
         prompt = await db.get_system_prompt(user_id)
         
         if prompt:
-            await update.message.reply_text(f"📝 Текущий системный промпт:\n{prompt}")
+            await outbound.reply_text(update.message, f"📝 Текущий системный промпт:\n{prompt}")
         else:
-            await update.message.reply_text("ℹ️ Системный промпт не установлен")
+            await outbound.reply_text(update.message, "ℹ️ Системный промпт не установлен")
     
     async def reset_context_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle /resetcontext command"""
         user_id = update.effective_user.id
+        # A reply still in flight would write its turn into the fresh context
+        self._cancel_inflight(user_id)
         await db.reset_context(user_id)
-        await update.message.reply_text("🗑️ Контекст чата сброшен")
+        await outbound.reply_text(update.message, "🗑️ Контекст чата сброшен")
+    
+    async def cancel_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Handle /cancel command"""
+        user_id = update.effective_user.id
+        
+        if self._cancel_inflight(user_id):
+            await outbound.reply_text(update.message, "⏹ Запрос отменён")
+        else:
+            await outbound.reply_text(update.message, "ℹ️ Нет активных запросов")
     
     async def ask_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle /ask command"""
         user_id = update.effective_user.id
         
         if not await db.can_send_message(user_id):
-            await update.message.reply_text(
+            await outbound.reply_text(
+                update.message,
                 "❌ Вы достигли лимита сообщений. Обновитесь до Plus тарифа для увеличения лимитов или дождитесь их сброса."
             )
             return
         
         if not context.args:
-            await update.message.reply_text("❌ Укажите вопрос после команды /ask")
+            await outbound.reply_text(update.message, "❌ Укажите вопрос после команды /ask")
             return
         
         query = " ".join(context.args)
-        await self._process_ai_request(update, user_id, query)
+        self._start_request(update, user_id, "ask", query)
     
     async def search_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle /search command - web search using Gemini online model"""
@@ -170,44 +296,49 @@ class TelegramBot:
         # Check if user has Plus tier
         user_data = await db.get_user_data(user_id)
         if not user_data or user_data['tier'] != 'plus':
-            await update.message.reply_text(
+            await outbound.reply_text(
+                update.message,
                 "🔒 Команда /search доступна только для Plus пользователей.\nИспользуйте /upgrade для обновления до Plus тарифа."
             )
             return
         
         if not await db.can_send_message(user_id):
-            await update.message.reply_text(
+            await outbound.reply_text(
+                update.message,
                 "❌ Вы достигли лимита сообщений. Дождитесь их сброса."
             )
             return
         
         if not context.args:
-            await update.message.reply_text("❌ Укажите поисковый запрос после команды /search")
+            await outbound.reply_text(update.message, "❌ Укажите поисковый запрос после команды /search")
             return
         
         query = " ".join(context.args)
-        await self._process_search_request(update, user_id, query)
-
+        self._start_request(update, user_id, "search", query)
+    
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle text messages"""
         # Check if message contains model selection
         text = update.message.text
         user_id = update.effective_user.id
         
+        # Most plain text is chatter; skip the database unless it names a model
+        if text not in Config.MODEL_NAMES:
+            return
+        
         available_models = await db.get_available_models(user_id)
         if text in available_models:
+            self._cancel_inflight(user_id)
             success = await db.set_user_model(user_id, text)
             if success:
-                await update.message.reply_text(
+                await outbound.reply_text(
+                    update.message,
                     f"✅ Модель изменена на: {text}",
                     reply_markup={"remove_keyboard": True}
                 )
             else:
-                await update.message.reply_text("❌ Ошибка изменения модели")
+                await outbound.reply_text(update.message, "❌ Ошибка изменения модели")
             return
-        
-        # For other messages, ignore unless it's a command
-        pass
     
     async def handle_media(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle media messages with /ask or /search command"""
@@ -220,11 +351,12 @@ class TelegramBot:
             if update.message.chat.type in ['group', 'supergroup']:
                 return
             # In private chats, show instruction message
-            await update.message.reply_text("📎 Для обработки файлов используйте команду /ask или /search в подписи к файлу")
+            await outbound.reply_text(update.message, "📎 Для обработки файлов используйте команду /ask или /search в подписи к файлу")
             return
         
         if not await db.can_send_message(user_id):
-            await update.message.reply_text(
+            await outbound.reply_text(
+                update.message,
                 "❌ Вы достигли лимита сообщений. Обновитесь до Plus тарифа для увеличения лимитов или дождитесь их сброса."
             )
             return
@@ -234,17 +366,284 @@ class TelegramBot:
             # Check if user has Plus tier for search
             user_data = await db.get_user_data(user_id)
             if not user_data or user_data['tier'] != 'plus':
-                await update.message.reply_text(
+                await outbound.reply_text(
+                    update.message,
                     "🔒 Команда /search доступна только для Plus пользователей.\nИспользуйте /upgrade для обновления до Plus тарифа."
                 )
                 return
             
             query = caption.replace("/search", "").strip()
-            await self._process_media_search_request(update, user_id, query)
+            self._start_request(update, user_id, "media_search", query)
         else:
             # Handle ask command with media
             query = caption.replace("/ask", "").strip()
-            await self._process_media_request(update, user_id, query)
+            self._start_request(update, user_id, "media_ask", query)
+    
+    def _cancel_inflight(self, user_id: int) -> bool:
+        """Cancel the user's in-flight AI request, if any"""
+        task = self._inflight.pop(user_id, None)
+        if task is None or task.done():
+            return False
+        task.cancel()
+        return True
+    
+    def _processor(self, kind: str) -> Callable[[Update, int, str], Coroutine[Any, Any, None]]:
+        """Request handler for a kind of AI request"""
+        return {
+            "ask": self._process_ai_request,
+            "search": self._process_search_request,
+            "media_ask": self._process_media_request,
+            "media_search": self._process_media_search_request
+        }[kind]
+    
+    @staticmethod
+    def _checkpoint(update: Update, user_id: int, kind: str, query: str) -> Dict[str, Any]:
+        """What a restarted instance needs to resume or settle a request"""
+        return {
+            "user_id": user_id,
+            "chat_id": update.message.chat_id,
+            "message_id": update.message.message_id,
+            "kind": kind,
+            "query": query,
+            "response": None
+        }
+    
+    def _start_request(self, update: Update, user_id: int, kind: str, query: str) -> None:
+        """Run an AI request in the background so the user's next updates are not held behind it"""
+        self.application.create_task(self._run_request(update, user_id, kind, query), update=update)
+    
+    async def _run_request(self, update: Update, user_id: int, kind: str, query: str) -> None:
+        """Run an AI request as the user's only in-flight request; the newest one wins.
+        
+        Cancelling the task aborts the pending OpenRouter call and its connection,
+        and the cancelled request never writes its turn to the context.
+        """
+        checkpoint = self._checkpoint(update, user_id, kind, query)
+        if self._draining:
+            # Requests that arrive while shutting down are left for the next instance
+            await db.save_inflight_requests([checkpoint])
+            return
+        
+        self._cancel_inflight(user_id)
+        task = asyncio.create_task(self._processor(kind)(update, user_id, query))
+        self._inflight[user_id] = task
+        self._checkpoints[user_id] = checkpoint
+        
+        try:
+            await task
+        except asyncio.CancelledError:
+            # Superseded requests end quietly; a cancelled caller must still propagate
+            current = asyncio.current_task()
+            if current is not None and current.cancelling():
+                raise
+        finally:
+            if self._inflight.get(user_id) is task:
+                del self._inflight[user_id]
+            if self._checkpoints.get(user_id) is checkpoint:
+                del self._checkpoints[user_id]
+    
+    def _answered(self, user_id: int, reply: str) -> None:
+        """Note that the request's turn is saved and charged, so only the reply remains"""
+        checkpoint = self._checkpoints.get(user_id)
+        if checkpoint is not None:
+            checkpoint["response"] = reply
+    
+    def _compact_later(self, user_id: int, context: List[Dict[str, Any]],
+                       message_content: List[Dict[str, Any]], response: str) -> None:
+        """Summarize the user's older turns in the background, unless shutting down"""
+        if self._draining:
+            # The context stays over budget, so the next instance compacts it
+            return
+        # The context as it is after this turn, so checking the budget needs no database read
+        messages = context + [
+            {"role": "user", "content": message_content},
+            {"role": "assistant", "content": [{"type": "text", "text": response}]}
+        ]
+        task = self.application.create_task(context_compactor.compact(user_id, messages))
+        self._compactions.add(task)
+        task.add_done_callback(self._compactions.discard)
+    
+    async def drain(self, timeout: float) -> None:
+        """Let in-flight requests finish, then checkpoint and cancel the rest along with pending summaries"""
+        self._draining = True
+        tasks = [task for task in self._inflight.values() if not task.done()]
+        if tasks:
+            logger.info(f"Waiting up to {timeout}s for {len(tasks)} in-flight requests")
+            await asyncio.wait(tasks, timeout=timeout)
+        
+        unfinished = []
+        for user_id, task in list(self._inflight.items()):
+            if task.done():
+                continue
+            unfinished.append(dict(self._checkpoints[user_id]))
+            task.cancel()
+        
+        if unfinished:
+            logger.warning(f"Checkpointing {len(unfinished)} unfinished requests")
+            await db.save_inflight_requests(unfinished)
+        
+        # Summaries are optional, and application.stop() would wait for them without a deadline
+        for task in list(self._compactions):
+            task.cancel()
+        logger.info(f"Model scheduler: {model_scheduler.snapshot()}")
+    
+    def _checkpoint_update(self, row: Dict[str, Any]) -> Update:
+        """Rebuild enough of the original update to reply to a checkpointed request"""
+        chat_type = ChatType.PRIVATE if row['chat_id'] > 0 else ChatType.SUPERGROUP
+        message = Message(
+            message_id=row['message_id'],
+            date=datetime.now(timezone.utc),
+            chat=Chat(id=row['chat_id'], type=chat_type)
+        )
+        message.set_bot(self.application.bot)
+        return Update(update_id=0, message=message)
+    
+    async def resume_requests(self) -> None:
+        """Settle requests checkpointed by an instance that shut down mid-flight"""
+        # Only this shard's users, so /cancel and newer requests reach the resumed ones
+        for row in await db.claim_inflight_requests(self.shard, max(Config.SHARD_WORKERS, 1)):
+            update = self._checkpoint_update(row)
+            try:
+                if row['response']:
+                    # The turn was saved and charged; only the reply was lost
+                    await outbound.reply_text(update.message, row['response'])
+                elif row['kind'] in ("ask", "search"):
+                    self._start_request(update, row['user_id'], row['kind'], row['query'])
+                else:
+                    # Attachments are not kept, and the request was never charged
+                    await outbound.reply_text(update.message, INTERRUPTED_MESSAGE)
+            except Exception as e:
+                logger.error(f"Error resuming request {row['id']}: {e}")
+    
+    @staticmethod
+    def _canonical_part(part: Dict[str, Any]) -> Dict[str, Any]:
+        """Rebuild a content part with a fixed key order"""
+        part_type = part.get("type")
+        if part_type == "text":
+            return {"type": "text", "text": part["text"]}
+        if part_type == "image_url":
+            return {"type": "image_url", "image_url": {"url": part["image_url"]["url"]}}
+        if part_type == "file":
+            return {"type": "file", "file": {"filename": part["file"].get("filename"), "file_data": part["file"]["file_data"]}}
+        return part
+    
+    def _build_messages(self, system_prompt: Optional[str], context: List[Dict[str, Any]], message_content: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Build API messages so the system prompt and earlier turns form a byte-stable prefix"""
+        messages = []
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+        
+        # JSONB reorders keys, so turns read back from the database are normalized
+        # to the layout they had when they were first sent
+        for message in context:
+            content = message["content"]
+            if not isinstance(content, str):
+                content = [self._canonical_part(part) for part in content]
+            messages.append({"role": message["role"], "content": content})
+        
+        messages.append({"role": "user", "content": message_content})
+        return messages
+    
+    async def _download_attachment(self, update: Update, attachment: Any, max_bytes: int, download_error: str = "❌ Ошибка скачивания файла") -> Optional[bytes]:
+        """Download a document or photo size, refusing files over the tier limit"""
+        too_large = f"❌ Файл слишком большой. Максимальный размер для вашего тарифа: {max_bytes // (1024 * 1024)} МБ"
+        
+        # Reject from the size Telegram reports, before spending any bandwidth
+        if attachment.file_size and attachment.file_size > max_bytes:
+            await outbound.reply_text(update.message, too_large)
+            return None
+        
+        file = await attachment.get_file()
+        try:
+            file_data = await self.file_processor.download_file(file.file_path, max_bytes)
+        except FileTooLargeError:
+            await outbound.reply_text(update.message, too_large)
+            return None
+        
+        if not file_data:
+            await outbound.reply_text(update.message, download_error)
+        return file_data
+    
+    async def _append_attachments(self, update: Update, tier: str, message_content: List[Dict[str, Any]]) -> bool:
+        """Add the message's document or photo to the content; False if the request should stop"""
+        max_bytes = Config.ATTACHMENT_LIMITS[tier]
+        
+        # Process document
+        if update.message.document:
+            doc = update.message.document
+            if doc.mime_type == "application/pdf":
+                file_data = await self._download_attachment(update, doc, max_bytes)
+                if not file_data:
+                    return False
+                
+                processed_data = self.file_processor.process_pdf(file_data)
+                if not processed_data:
+                    await outbound.reply_text(update.message, "❌ Ошибка обработки PDF файла")
+                    return False
+                
+                message_content.append({
+                    "type": "file",
+                    "file": {
+                        "filename": doc.file_name,
+                        "file_data": processed_data
+                    }
+                })
+            
+            elif doc.mime_type.startswith("image/"):
+                file_data = await self._download_attachment(update, doc, max_bytes)
+                if not file_data:
+                    return False
+                
+                processed_data = self.file_processor.process_image(file_data, doc.mime_type)
+                if not processed_data:
+                    await outbound.reply_text(update.message, "❌ Ошибка обработки изображения")
+                    return False
+                
+                message_content.append({
+                    "type": "image_url",
+                    "image_url": {"url": processed_data}
+                })
+            else:
+                await outbound.reply_text(update.message, "❌ Неподдерживаемый тип файла. Поддерживаются только PDF и изображения.")
+                return False
+        
+        # Process photo
+        if update.message.photo:
+            # The image is downscaled anyway, so fetch the smallest size that still covers the target
+            photo = self.file_processor.select_photo_size(update.message.photo, Config.IMAGE_MAX_SIDE)
+            file_data = await self._download_attachment(update, photo, max_bytes, "❌ Ошибка скачивания изображения")
+            if not file_data:
+                return False
+            
+            processed_data = self.file_processor.process_image(file_data, "image/jpeg")
+            if not processed_data:
+                await outbound.reply_text(update.message, "❌ Ошибка обработки изображения")
+                return False
+            
+            message_content.append({
+                "type": "image_url",
+                "image_url": {"url": processed_data}
+            })
+        
+        return True
+    
+    @staticmethod
+    def _resolve_model(user_data: Dict[str, Any], messages: List[Dict[str, Any]], message_content: List[Dict[str, Any]]) -> str:
+        """The user's model, or the one routing picks for "auto" users"""
+        model = user_data.get('current_model') or 'openai/gpt-4.1'
+        if model != Config.AUTO_MODEL:
+            return model
+        return model_router.choose(
+            Config.AVAILABLE_MODELS[user_data['tier']],
+            messages,
+            has_attachments=any(part["type"] != "text" for part in message_content)
+        )
+    
+    async def _complete(self, tier: str, messages: List[Dict[str, Any]], model: str,
+                        plugins: List[Dict[str, Any]] = None) -> CompletionResult:
+        """Get a completion once the user's tier gets a model slot"""
+        async with model_scheduler.slot(tier):
+            return await openrouter_client.get_completion(messages, model, plugins=plugins)
     
     async def _process_ai_request(self, update: Update, user_id: int, query: str) -> None:
         """Process AI request"""
@@ -255,32 +654,39 @@ class TelegramBot:
             # Prepare message content
             message_content = [{"type": "text", "text": query}]
             
-            # Get context and system prompt
-            context = await db.get_context(user_id)
-            system_prompt = await db.get_system_prompt(user_id)
-            model = await db.get_user_model(user_id)
+            # Get context and system prompt; the context comes from the cache while its version is current
+            user_data = await db.get_user_data(user_id)
+            context = await db.get_context(user_id, version=user_data['context_version'])
+            system_prompt = user_data.get('system_prompt')
             
             # Build messages for API
-            messages = []
-            if system_prompt:
-                messages.append({"role": "system", "content": system_prompt})
+            messages = self._build_messages(system_prompt, context, message_content)
             
-            messages.extend(context)
-            messages.append({"role": "user", "content": message_content})
+            model = self._resolve_model(user_data, messages, message_content)
             
             # Get AI response
-            response = await openrouter_client.get_completion(messages, model)
+            result = await self._complete(user_data['tier'], messages, model)
+            await db.record_usage(user_id, result)
+            response = result.content
             
             # Save to context
             await db.add_message_to_context(user_id, "user", message_content)
             await db.add_message_to_context(user_id, "assistant", [{"type": "text", "text": response}])
             
             # Send response
-            await update.message.reply_text(f"🤖 {response}")
+            reply = f"🤖 {response}"
+            self._answered(user_id, reply)
+            await outbound.reply_text(update.message, reply)
             
+            # Summarize older turns in the background once the user has the answer
+            self._compact_later(user_id, context, message_content, response)
+        
+        except OverloadedError as e:
+            logger.warning(str(e))
+            await outbound.reply_text(update.message, OVERLOADED_MESSAGE)
         except Exception as e:
             logger.error(f"Error processing AI request: {e}")
-            await update.message.reply_text("❌ Произошла ошибка при обработке запроса")
+            await outbound.reply_text(update.message, "❌ Произошла ошибка при обработке запроса")
     
     async def _process_media_request(self, update: Update, user_id: int, query: str) -> None:
         """Process media request"""
@@ -291,101 +697,49 @@ class TelegramBot:
             if query:
                 message_content.append({"type": "text", "text": query})
             
-            # Process document
-            if update.message.document:
-                doc = update.message.document
-                if doc.mime_type == "application/pdf":
-                    file = await doc.get_file()
-                    file_data = await self.file_processor.download_file(file.file_path)
-                    
-                    if file_data:
-                        processed_data = self.file_processor.process_pdf(file_data)
-                        if processed_data:
-                            message_content.append({
-                                "type": "file",
-                                "file": {
-                                    "filename": doc.file_name,
-                                    "file_data": processed_data
-                                }
-                            })
-                        else:
-                            await update.message.reply_text("❌ Ошибка обработки PDF файла")
-                            return
-                    else:
-                        await update.message.reply_text("❌ Ошибка скачивания файла")
-                        return
-                
-                elif doc.mime_type.startswith("image/"):
-                    file = await doc.get_file()
-                    file_data = await self.file_processor.download_file(file.file_path)
-                    
-                    if file_data:
-                        processed_data = self.file_processor.process_image(file_data, doc.mime_type)
-                        if processed_data:
-                            message_content.append({
-                                "type": "image_url",
-                                "image_url": {"url": processed_data}
-                            })
-                        else:
-                            await update.message.reply_text("❌ Ошибка обработки изображения")
-                            return
-                    else:
-                        await update.message.reply_text("❌ Ошибка скачивания файла")
-                        return
-                else:
-                    await update.message.reply_text("❌ Неподдерживаемый тип файла. Поддерживаются только PDF и изображения.")
-                    return
-            
-            # Process photo
-            if update.message.photo:
-                photo = update.message.photo[-1]  # Get highest resolution
-                file = await photo.get_file()
-                file_data = await self.file_processor.download_file(file.file_path)
-                
-                if file_data:
-                    processed_data = self.file_processor.process_image(file_data, "image/jpeg")
-                    if processed_data:
-                        message_content.append({
-                            "type": "image_url",
-                            "image_url": {"url": processed_data}
-                        })
-                    else:
-                        await update.message.reply_text("❌ Ошибка обработки изображения")
-                        return
-                else:
-                    await update.message.reply_text("❌ Ошибка скачивания изображения")
-                    return
+            # The tier sets the attachment size limit and the model slot priority
+            user_data = await db.get_user_data(user_id)
+            
+            # Download and process attachments
+            if not await self._append_attachments(update, user_data['tier'], message_content):
+                return
             
             if not message_content:
-                await update.message.reply_text("❌ Нет содержимого для обработки")
+                await outbound.reply_text(update.message, "❌ Нет содержимого для обработки")
                 return
             
-            # Get context and system prompt
-            context = await db.get_context(user_id)
-            system_prompt = await db.get_system_prompt(user_id)
-            model = await db.get_user_model(user_id)
+            # Get context and system prompt; the context comes from the cache while its version is current
+            context = await db.get_context(user_id, version=user_data['context_version'])
+            system_prompt = user_data.get('system_prompt')
             
             # Build messages for API
-            messages = []
-            if system_prompt:
-                messages.append({"role": "system", "content": system_prompt})
+            messages = self._build_messages(system_prompt, context, message_content)
             
-            messages.extend(context)
-            messages.append({"role": "user", "content": message_content})
+            model = self._resolve_model(user_data, messages, message_content)
             
             # Get AI response
-            response = await openrouter_client.get_completion(messages, model)
+            result = await self._complete(user_data['tier'], messages, model)
+            await db.record_usage(user_id, result)
+            response = result.content
             
             # Save to context
-            await db.add_message_to_context(user_id, "user", message_content)
+            await db.add_message_to_context(user_id, "user", Attachment.materialize(message_content))
             await db.add_message_to_context(user_id, "assistant", [{"type": "text", "text": response}])
             
             # Send response
-            await update.message.reply_text(f"🤖 {response}")
+            reply = f"🤖 {response}"
+            self._answered(user_id, reply)
+            await outbound.reply_text(update.message, reply)
             
+            # Summarize older turns in the background once the user has the answer
+            self._compact_later(user_id, context, message_content, response)
+        
+        except OverloadedError as e:
+            logger.warning(str(e))
+            await outbound.reply_text(update.message, OVERLOADED_MESSAGE)
         except Exception as e:
             logger.error(f"Error processing media request: {e}")
-            await update.message.reply_text("❌ Произошла ошибка при обработке запроса")
+            await outbound.reply_text(update.message, "❌ Произошла ошибка при обработке запроса")
     
     async def _process_search_request(self, update: Update, user_id: int, query: str) -> None:
         """Process search request using Gemini online model"""
@@ -396,9 +750,10 @@ class TelegramBot:
             # Prepare message content for search
             message_content = [{"type": "text", "text": query}]
             
-            # Get context and system prompt
-            context = await db.get_context(user_id)
-            system_prompt = await db.get_system_prompt(user_id)
+            # Get context and system prompt; the context comes from the cache while its version is current
+            user_data = await db.get_user_data(user_id)
+            context = await db.get_context(user_id, version=user_data['context_version'])
+            system_prompt = user_data.get('system_prompt')
             
             # Use the special Gemini online model for search
             search_model = "google/gemini-2.5-flash"
@@ -411,26 +766,31 @@ class TelegramBot:
             }]
             
             # Build messages for API
-            messages = []
-            if system_prompt:
-                messages.append({"role": "system", "content": system_prompt})
-            
-            messages.extend(context)
-            messages.append({"role": "user", "content": message_content})
+            messages = self._build_messages(system_prompt, context, message_content)
             
             # Get AI response with web search
-            response = await openrouter_client.get_completion(messages, search_model, plugins=search_plugins)
+            result = await self._complete(user_data['tier'], messages, search_model, plugins=search_plugins)
+            await db.record_usage(user_id, result)
+            response = result.content
             
             # Save to context
             await db.add_message_to_context(user_id, "user", message_content)
             await db.add_message_to_context(user_id, "assistant", [{"type": "text", "text": response}])
             
             # Send response with search indicator
-            await update.message.reply_text(f"🔍 Результат поиска:\n\n{response}")
+            reply = f"🔍 Результат поиска:\n\n{response}"
+            self._answered(user_id, reply)
+            await outbound.reply_text(update.message, reply)
             
+            # Summarize older turns in the background once the user has the answer
+            self._compact_later(user_id, context, message_content, response)
+        
+        except OverloadedError as e:
+            logger.warning(str(e))
+            await outbound.reply_text(update.message, OVERLOADED_MESSAGE)
         except Exception as e:
             logger.error(f"Error processing search request: {e}")
-            await update.message.reply_text("❌ Произошла ошибка при выполнении поиска")
+            await outbound.reply_text(update.message, "❌ Произошла ошибка при выполнении поиска")
     
     async def _process_media_search_request(self, update: Update, user_id: int, query: str) -> None:
         """Process media search request using Gemini online model"""
@@ -441,78 +801,20 @@ class TelegramBot:
             if query:
                 message_content.append({"type": "text", "text": query})
             
-            # Process document
-            if update.message.document:
-                doc = update.message.document
-                if doc.mime_type == "application/pdf":
-                    file = await doc.get_file()
-                    file_data = await self.file_processor.download_file(file.file_path)
-                    
-                    if file_data:
-                        processed_data = self.file_processor.process_pdf(file_data)
-                        if processed_data:
-                            message_content.append({
-                                "type": "file",
-                                "file": {
-                                    "filename": doc.file_name,
-                                    "file_data": processed_data
-                                }
-                            })
-                        else:
-                            await update.message.reply_text("❌ Ошибка обработки PDF файла")
-                            return
-                    else:
-                        await update.message.reply_text("❌ Ошибка скачивания файла")
-                        return
-                
-                elif doc.mime_type.startswith("image/"):
-                    file = await doc.get_file()
-                    file_data = await self.file_processor.download_file(file.file_path)
-                    
-                    if file_data:
-                        processed_data = self.file_processor.process_image(file_data, doc.mime_type)
-                        if processed_data:
-                            message_content.append({
-                                "type": "image_url",
-                                "image_url": {"url": processed_data}
-                            })
-                        else:
-                            await update.message.reply_text("❌ Ошибка обработки изображения")
-                            return
-                    else:
-                        await update.message.reply_text("❌ Ошибка скачивания файла")
-                        return
-                else:
-                    await update.message.reply_text("❌ Неподдерживаемый тип файла. Поддерживаются только PDF и изображения.")
-                    return
-            
-            # Process photo
-            if update.message.photo:
-                photo = update.message.photo[-1]  # Get highest resolution
-                file = await photo.get_file()
-                file_data = await self.file_processor.download_file(file.file_path)
-                
-                if file_data:
-                    processed_data = self.file_processor.process_image(file_data, "image/jpeg")
-                    if processed_data:
-                        message_content.append({
-                            "type": "image_url",
-                            "image_url": {"url": processed_data}
-                        })
-                    else:
-                        await update.message.reply_text("❌ Ошибка обработки изображения")
-                        return
-                else:
-                    await update.message.reply_text("❌ Ошибка скачивания изображения")
-                    return
+            # The tier sets the attachment size limit and the model slot priority
+            user_data = await db.get_user_data(user_id)
+            
+            # Download and process attachments
+            if not await self._append_attachments(update, user_data['tier'], message_content):
+                return
             
             if not message_content:
-                await update.message.reply_text("❌ Нет содержимого для поиска")
+                await outbound.reply_text(update.message, "❌ Нет содержимого для поиска")
                 return
             
-            # Get context and system prompt
-            context = await db.get_context(user_id)
-            system_prompt = await db.get_system_prompt(user_id)
+            # Get context and system prompt; the context comes from the cache while its version is current
+            context = await db.get_context(user_id, version=user_data['context_version'])
+            system_prompt = user_data.get('system_prompt')
             
             # Use the special Gemini online model for search
             search_model = "google/gemini-2.5-flash"
@@ -525,27 +827,32 @@ class TelegramBot:
             }]
             
             # Build messages for API
-            messages = []
-            if system_prompt:
-                messages.append({"role": "system", "content": system_prompt})
-            
-            messages.extend(context)
-            messages.append({"role": "user", "content": message_content})
+            messages = self._build_messages(system_prompt, context, message_content)
             
             # Get AI response with web search
-            response = await openrouter_client.get_completion(messages, search_model, plugins=search_plugins)
+            result = await self._complete(user_data['tier'], messages, search_model, plugins=search_plugins)
+            await db.record_usage(user_id, result)
+            response = result.content
             
             # Save to context
-            await db.add_message_to_context(user_id, "user", message_content)
+            await db.add_message_to_context(user_id, "user", Attachment.materialize(message_content))
             await db.add_message_to_context(user_id, "assistant", [{"type": "text", "text": response}])
             
             # Send response with search indicator
-            await update.message.reply_text(f"🔍 Результат поиска:\n\n{response}")
+            reply = f"🔍 Результат поиска:\n\n{response}"
+            self._answered(user_id, reply)
+            await outbound.reply_text(update.message, reply)
             
+            # Summarize older turns in the background once the user has the answer
+            self._compact_later(user_id, context, message_content, response)
+        
+        except OverloadedError as e:
+            logger.warning(str(e))
+            await outbound.reply_text(update.message, OVERLOADED_MESSAGE)
         except Exception as e:
             logger.error(f"Error processing media search request: {e}")
-            await update.message.reply_text("❌ Произошла ошибка при выполнении поиска")
-
+            await outbound.reply_text(update.message, "❌ Произошла ошибка при выполнении поиска")
+    
     async def handle_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle callback queries"""
         query = update.callback_query
@@ -556,6 +863,7 @@ class TelegramBot:
         
         if data.startswith("model_"):
             model = data.replace("model_", "")
+            self._cancel_inflight(user_id)
             success = await db.set_user_model(user_id, model)
             
             if success:
@@ -570,61 +878,106 @@ class TelegramBot:
                     )])
                 
                 reply_markup = InlineKeyboardMarkup(keyboard)
-                await query.edit_message_text(
+                await outbound.edit_message_text(
+                    query,
                     f"🤖 Выберите модель:\n\nТекущая модель: {model}",
                     reply_markup=reply_markup
                 )
             else:
-                await query.edit_message_text("❌ Эта модель недоступна для вашего тарифа")
+                await outbound.edit_message_text(query, "❌ Эта модель недоступна для вашего тарифа")
     
     async def handle_pre_checkout(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle pre-checkout queries"""
         query = update.pre_checkout_query
         
-        # Always approve pre-checkout for Telegram Stars
-        await query.answer(ok=True)
+        # Telegram gives only a few seconds to answer, so validate from the invoice alone
+        valid = (
+            query.invoice_payload == f"upgrade_plus_{query.from_user.id}" and
+            query.currency == "XTR" and
+            query.total_amount == Config.SUBSCRIPTION_PRICE_STARS
+        )
         
-        # Process successful payment
+        if valid:
+            await query.answer(ok=True)
+        else:
+            logger.warning(f"Rejecting pre-checkout query {query.id} with payload {query.invoice_payload}")
+            await query.answer(ok=False, error_message="Счёт устарел. Запросите новый с помощью /upgrade")
+    
+    async def handle_successful_payment(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Handle successful payments"""
+        payment = update.message.successful_payment
         user_id = update.effective_user.id
         
-        # Upgrade user to Plus
-        subscription_end_date = datetime.now() + timedelta(days=30)
-        success = await db.upgrade_to_plus(user_id, subscription_end_date)
-        
-        if success:
-            # Record payment
-            await db.record_payment(
-                user_id,
-                query.telegram_payment_charge_id,
-                Config.SUBSCRIPTION_PRICE_STARS,
-                "XTR"
-            )
-            
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"""🎉 Спасибо за обновление до Plus тарифа! Ваша подписка активна.
+        result = await db.fulfil_plus_payment(
+            user_id,
+            payment.telegram_payment_charge_id,
+            payment.total_amount,
+            payment.currency,
+            Config.SUBSCRIPTION_DAYS
+        )
+        
+        if not result:
+            await outbound.reply_text(update.message, "❌ Произошла ошибка при обработке платежа. Обратитесь в поддержку.")
+            return
+        
+        # A redelivered payment was already confirmed to the user
+        if not result['newly_fulfilled']:
+            return
+        
+        subscription_end_date = datetime.fromisoformat(result['subscription_end_date'])
+        await outbound.reply_text(
+            update.message,
+            f"""🎉 Спасибо за обновление до Plus тарифа! Ваша подписка активна.
 
 Ваши преимущества:
 • 50 сообщений в день
 • 500 сообщений в месяц  
 • Доступ к премиум моделям
 • Подписка действует до {subscription_end_date.strftime('%d.%m.%Y')}"""
-            )
-        else:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="❌ Произошла ошибка при обработке платежа. Обратитесь в поддержку."
-            )
+        )
     
     async def error_handler(self, update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle errors"""
         logger.error(f"Exception while handling an update: {context.error}")
     
+    async def start_worker(self) -> None:
+        """Start handling updates put into the update queue, without polling"""
+        await self.application.initialize()
+        await self._post_init(self.application)
+        await self.application.start()
+        self.application.create_task(self.resume_requests())
+    
+    async def stop_worker(self) -> None:
+        """Finish running requests and queued updates, then release clients"""
+        await self.drain(Config.SHUTDOWN_GRACE_SECONDS)
+        await self.application.stop()
+        await self.application.shutdown()
+        await self._post_shutdown(self.application)
+    
+    async def _serve(self) -> None:
+        """Poll until SIGINT or SIGTERM, then drain instead of dropping requests"""
+        stop = asyncio.Event()
+        install_stop_handlers(stop)
+        
+        await self.start_worker()
+        await self.application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        try:
+            await stop.wait()
+        finally:
+            logger.info("Stopping bot...")
+            # Stop taking new updates first; ones already fetched are checkpointed by _run_request
+            await self.application.updater.stop()
+            await self.stop_worker()
+    
     def run(self):
         """Run the bot"""
         logger.info("Starting bot...")
-        self.application.run_polling(allowed_updates=Update.ALL_TYPES)
+        asyncio.run(self._serve())
 
 if __name__ == "__main__":
-    bot = TelegramBot()
-    bot.run()
\ No newline at end of file
+    if Config.SHARD_WORKERS > 1:
+        from sharding import ShardSupervisor
+        ShardSupervisor(Config.SHARD_WORKERS).run()
+    else:
+        bot = TelegramBot()
+        bot.run()
\ No newline at end of file
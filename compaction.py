@@ -0,0 +1,104 @@
+import logging
+from typing import List, Dict, Any, Set
+from config import Config
+from database import db
+from openrouter import openrouter_client, OpenRouterError
+from scheduling import model_scheduler, OverloadedError
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = (
+    "Summarize the conversation below so it can replace the original messages as context "
+    "for future replies. Keep facts, names, numbers, decisions, open questions and the user's "
+    "preferences. Write in the language of the conversation, as plain text, without any preamble."
+)
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+# Rough cost of an image or PDF, which can't be measured from its base64 size
+ATTACHMENT_TOKENS = 1000
+
+class ContextCompactor:
+    def __init__(self):
+        self._running: Set[int] = set()
+    
+    @staticmethod
+    def estimate_tokens(messages: List[Dict[str, Any]]) -> int:
+        """Estimate the prompt size of context messages"""
+        tokens = 0
+        for message in messages:
+            content = message['content']
+            if isinstance(content, str):
+                tokens += len(content) // 4
+                continue
+            for part in content:
+                if part.get('type') == 'text':
+                    tokens += len(part['text']) // 4
+                else:
+                    tokens += ATTACHMENT_TOKENS
+        return tokens
+    
+    @staticmethod
+    def render_transcript(messages: List[Dict[str, Any]]) -> str:
+        """Render context messages as plain text for the summary model"""
+        lines = []
+        for message in messages:
+            content = message['content']
+            if isinstance(content, str):
+                content = [{'type': 'text', 'text': content}]
+            
+            texts = []
+            for part in content:
+                if part.get('type') == 'text':
+                    texts.append(part['text'])
+                elif part.get('type') == 'file':
+                    texts.append(f"[attached file: {part['file'].get('filename', 'document')}]")
+                else:
+                    texts.append("[attached image]")
+            
+            lines.append(f"{message['role'].capitalize()}: {' '.join(texts)}")
+        return "\n\n".join(lines)
+    
+    def needs_compaction(self, messages: List[Dict[str, Any]]) -> bool:
+        """Check whether the context is over budget and has turns to fold"""
+        return (len(messages) > Config.CONTEXT_COMPACTION_KEEP and
+                self.estimate_tokens(messages) > Config.CONTEXT_COMPACTION_BUDGET_TOKENS)
+    
+    async def compact(self, user_id: int, messages: List[Dict[str, Any]]) -> None:
+        """Summarize older turns of a user's context if it exceeds the budget"""
+        # The budget is checked on the caller's copy, so the rows are only read once it is over
+        if not Config.CONTEXT_COMPACTION or user_id in self._running or not self.needs_compaction(messages):
+            return
+        
+        self._running.add(user_id)
+        try:
+            rows = await db.get_context_rows(user_id)
+            if not self.needs_compaction(rows):
+                return
+            
+            older = rows[:-Config.CONTEXT_COMPACTION_KEEP] if Config.CONTEXT_COMPACTION_KEEP > 0 else rows
+            # Summaries are background work, so they queue with the lowest priority
+            async with model_scheduler.slot("lite"):
+                result = await openrouter_client.complete([
+                    {"role": "system", "content": SUMMARY_PROMPT},
+                    {"role": "user", "content": self.render_transcript(older)}
+                ], Config.SUMMARY_MODEL)
+            await db.record_usage(user_id, result, kind='summary')
+            
+            await db.compact_context(
+                user_id,
+                [row['id'] for row in older],
+                [{"type": "text", "text": SUMMARY_PREFIX + result.content}]
+            )
+        except OverloadedError as e:
+            # The context stays over budget, so the next request tries again
+            logger.warning(f"Skipping context summary: {e}")
+        except OpenRouterError as e:
+            logger.error(f"Error summarizing context: {e}")
+        except Exception as e:
+            logger.error(f"Error compacting context: {e}")
+        finally:
+            self._running.discard(user_id)
+
+# Global context compactor instance
+context_compactor = ContextCompactor()
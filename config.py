@@ -3,13 +3,62 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+def _optional_int(name: str):
+    """Read an integer environment variable, None when unset"""
+    value = os.getenv(name)
+    return int(value) if value else None
+
 class Config:
     TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
     OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
     SUPABASE_URL = os.getenv("SUPABASE_URL")
     SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+    DATABASE_URL = os.getenv("DATABASE_URL")
     SUBSCRIPTION_PRICE_STARS = int(os.getenv("SUBSCRIPTION_PRICE_STARS", "300"))
+    SUBSCRIPTION_DAYS = 30
     CONTEXT_SIZE = int(os.getenv("CONTEXT_SIZE", "10"))
+    CONTEXT_CACHE_MAX_BYTES = int(os.getenv("CONTEXT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+    
+    # Context compaction: summarize older turns instead of dropping them
+    CONTEXT_COMPACTION = os.getenv("CONTEXT_COMPACTION", "false").lower() == "true"
+    CONTEXT_COMPACTION_BUDGET_TOKENS = int(os.getenv("CONTEXT_COMPACTION_BUDGET_TOKENS", "4000"))
+    CONTEXT_COMPACTION_KEEP = int(os.getenv("CONTEXT_COMPACTION_KEEP", "4"))
+    SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "google/gemini-2.5-flash")
+    
+    # Usage accounting
+    USAGE_FLUSH_INTERVAL_MS = int(os.getenv("USAGE_FLUSH_INTERVAL_MS", "250"))
+    USAGE_JOURNAL_DIR = os.getenv("USAGE_JOURNAL_DIR", "data/usage")
+    USAGE_EVENTS_BACKLOG = int(os.getenv("USAGE_EVENTS_BACKLOG", "10000"))
+    USAGE_EVENTS_RETENTION_DAYS = int(os.getenv("USAGE_EVENTS_RETENTION_DAYS", "0"))
+    
+    # Duplicate update suppression
+    DEDUPE_WINDOW_SECONDS = int(os.getenv("DEDUPE_WINDOW_SECONDS", "600"))
+    DEDUPE_MAX_ENTRIES = int(os.getenv("DEDUPE_MAX_ENTRIES", "100000"))
+    DEDUPE_SHARED = os.getenv("DEDUPE_SHARED", "false").lower() == "true"
+    
+    # Maintenance jobs
+    MAINTENANCE_INTERVAL_SECONDS = int(os.getenv("MAINTENANCE_INTERVAL_SECONDS", "300"))
+    CONTEXT_RETENTION_DAYS = int(os.getenv("CONTEXT_RETENTION_DAYS", "30"))
+    
+    # Time in-flight requests get to finish on shutdown before they are checkpointed
+    SHUTDOWN_GRACE_SECONDS = int(os.getenv("SHUTDOWN_GRACE_SECONDS", "20"))
+    
+    # Sharded worker mode; with SHARD_WORKERS above 1 a front process feeds that many workers
+    SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "1"))
+    SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", "1000"))
+    SHARD_HEARTBEAT_TIMEOUT_SECONDS = int(os.getenv("SHARD_HEARTBEAT_TIMEOUT_SECONDS", "30"))
+    SHARD_DRAIN_SECONDS = int(os.getenv("SHARD_DRAIN_SECONDS", "25"))
+    
+    # Webhook of the front process; without WEBHOOK_URL it polls instead
+    WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+    WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8000"))
+    WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")
+    
+    # Outbound Telegram rate limits, per second except for groups
+    OUTBOUND_GLOBAL_RATE = int(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+    OUTBOUND_PRIVATE_CHAT_RATE = int(os.getenv("OUTBOUND_PRIVATE_CHAT_RATE", "1"))
+    OUTBOUND_GROUP_CHAT_RATE_PER_MINUTE = int(os.getenv("OUTBOUND_GROUP_CHAT_RATE_PER_MINUTE", "20"))
+    OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
     
     # Model configuration
     AVAILABLE_MODELS = {
@@ -25,14 +74,53 @@ class Config:
         ]
     }
     
-    # Usage limits
+    # Attachments
+    IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1024"))
+    ATTACHMENT_LIMITS = {
+        "lite": int(os.getenv("LITE_ATTACHMENT_MAX_BYTES", str(10 * 1024 * 1024))),
+        "plus": int(os.getenv("PLUS_ATTACHMENT_MAX_BYTES", str(20 * 1024 * 1024)))
+    }
+    
+    # Automatic model routing
+    AUTO_MODEL = "auto"
+    ROUTING_MIN_SAMPLES = int(os.getenv("ROUTING_MIN_SAMPLES", "5"))
+    ROUTING_MAX_ERROR_RATE = float(os.getenv("ROUTING_MAX_ERROR_RATE", "0.25"))
+    ROUTING_HEAVY_REQUEST_CHARS = int(os.getenv("ROUTING_HEAVY_REQUEST_CHARS", "4000"))
+    ROUTING_STATS_WINDOW_SECONDS = int(os.getenv("ROUTING_STATS_WINDOW_SECONDS", "300"))
+    
+    # Fair scheduling of model requests; sheddable tiers are rejected first under overload
+    MODEL_CONCURRENCY = int(os.getenv("MODEL_CONCURRENCY", "16"))
+    SCHEDULER_TIERS = {
+        "lite": {
+            "weight": int(os.getenv("LITE_SCHEDULER_WEIGHT", "1")),
+            "max_queue": int(os.getenv("LITE_MAX_QUEUE", "20")),
+            "sheddable": True
+        },
+        "plus": {
+            "weight": int(os.getenv("PLUS_SCHEDULER_WEIGHT", "4")),
+            "max_queue": int(os.getenv("PLUS_MAX_QUEUE", "200")),
+            "sheddable": False
+        }
+    }
+    SCHEDULER_WAIT_SLO_MS = int(os.getenv("SCHEDULER_WAIT_SLO_MS", "2000"))
+    SCHEDULER_WAIT_WINDOW_SECONDS = int(os.getenv("SCHEDULER_WAIT_WINDOW_SECONDS", "60"))
+    SCHEDULER_STATS_INTERVAL_SECONDS = int(os.getenv("SCHEDULER_STATS_INTERVAL_SECONDS", "60"))
+    
+    # Every name a user can pick, for routing messages without a database lookup
+    MODEL_NAMES = frozenset([AUTO_MODEL] + [model for models in AVAILABLE_MODELS.values() for model in models])
+    
+    # Usage limits; token limits are optional and disabled when unset
     USAGE_LIMITS = {
         "lite": {
             "daily": 20,
-            "monthly": 100
+            "monthly": 100,
+            "daily_tokens": _optional_int("LITE_DAILY_TOKENS"),
+            "monthly_tokens": _optional_int("LITE_MONTHLY_TOKENS")
         },
         "plus": {
             "daily": 100,
-            "monthly": 1000
+            "monthly": 1000,
+            "daily_tokens": _optional_int("PLUS_DAILY_TOKENS"),
+            "monthly_tokens": _optional_int("PLUS_MONTHLY_TOKENS")
         }
     }
\ No newline at end of file
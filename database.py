@@ -1,33 +1,275 @@
 import asyncio
+import json
 import logging
+import uuid
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import List, Dict, Optional, Any
+from pathlib import Path
+from typing import List, Dict, Optional, Any, Tuple
 from supabase import create_client, Client
 from config import Config
+from schema import migration_runner
+from openrouter import CompletionResult
 
 logger = logging.getLogger(__name__)
 
+class UsageLedger:
+    """Message and token counts applied locally and flushed to the users table in batches.
+    
+    Every increment is appended to a local journal before it is acknowledged.
+    On flush the journal is rotated into a batch file named after the batch id,
+    so a batch that was sent but not confirmed is retried with the same id and
+    the database applies it at most once.
+    """
+    
+    CURRENT_JOURNAL = "current.journal"
+    
+    def __init__(self, journal_dir: str):
+        self.journal_dir = Path(journal_dir)
+        self._pending: Dict[int, List[int]] = {}
+        self._batches: Dict[str, Dict[int, List[int]]] = {}
+        self._journal = None
+    
+    def open(self) -> None:
+        """Recover unflushed batches from disk and start a fresh journal"""
+        self.journal_dir.mkdir(parents=True, exist_ok=True)
+        
+        current = self.journal_dir / self.CURRENT_JOURNAL
+        if current.exists():
+            current.rename(self.journal_dir / f"{uuid.uuid4()}.journal")
+        
+        for path in sorted(self.journal_dir.glob("*.journal")):
+            deltas = self._read_journal(path)
+            if deltas:
+                self._batches[path.stem] = deltas
+            else:
+                path.unlink()
+        
+        if self._batches:
+            logger.info(f"Recovered {len(self._batches)} unflushed usage batches")
+        
+        self._journal = open(current, "a", encoding="utf-8")
+    
+    def close(self) -> None:
+        """Close the journal file"""
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+    
+    @staticmethod
+    def _read_journal(path: Path) -> Dict[int, List[int]]:
+        """Aggregate a journal file into per-user [count, tokens] deltas"""
+        deltas: Dict[int, List[int]] = {}
+        with open(path, encoding="utf-8") as journal:
+            for line in journal:
+                parts = line.split()
+                # A torn last line from a crash is skipped
+                if len(parts) not in (2, 3) or not line.endswith("\n"):
+                    continue
+                user_id, count = int(parts[0]), int(parts[1])
+                tokens = int(parts[2]) if len(parts) == 3 else 0
+                delta = deltas.setdefault(user_id, [0, 0])
+                delta[0] += count
+                delta[1] += tokens
+        return deltas
+    
+    def add(self, user_id: int, count: int = 1, tokens: int = 0) -> None:
+        """Record an increment locally and in the journal"""
+        delta = self._pending.setdefault(user_id, [0, 0])
+        delta[0] += count
+        delta[1] += tokens
+        if self._journal is not None:
+            self._journal.write(f"{user_id} {count} {tokens}\n")
+            self._journal.flush()
+    
+    def unflushed(self, user_id: int) -> Tuple[int, int]:
+        """Message and token counts not yet confirmed by the database for a user"""
+        count, tokens = self._pending.get(user_id, (0, 0))
+        for batch in self._batches.values():
+            batch_count, batch_tokens = batch.get(user_id, (0, 0))
+            count += batch_count
+            tokens += batch_tokens
+        return count, tokens
+    
+    def rotate(self) -> None:
+        """Turn the pending increments into a batch ready to be flushed"""
+        if not self._pending:
+            return
+        
+        batch_id = str(uuid.uuid4())
+        self._batches[batch_id] = self._pending
+        self._pending = {}
+        
+        if self._journal is not None:
+            self._journal.close()
+            current = self.journal_dir / self.CURRENT_JOURNAL
+            current.rename(self.journal_dir / f"{batch_id}.journal")
+            self._journal = open(current, "a", encoding="utf-8")
+    
+    def batches(self) -> List[tuple]:
+        """Batches waiting to be applied, oldest first"""
+        return list(self._batches.items())
+    
+    def confirm(self, batch_id: str) -> None:
+        """Forget a batch the database has applied"""
+        self._batches.pop(batch_id, None)
+        path = self.journal_dir / f"{batch_id}.journal"
+        if path.exists():
+            path.unlink()
+
+class ContextCache:
+    """Recent context messages per user, within a byte budget with LRU eviction.
+    
+    Each entry is tagged with the user's context_version. A read only hits when
+    the caller's version matches, so changes made by other instances or by
+    maintenance are detected instead of served stale.
+    """
+    
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries: "OrderedDict[int, Tuple[int, List[Dict[str, Any]], List[int]]]" = OrderedDict()
+    
+    @staticmethod
+    def _size(message: Dict[str, Any]) -> int:
+        return len(json.dumps(message['content'], ensure_ascii=False))
+    
+    def get(self, user_id: int, version: int) -> Optional[List[Dict[str, Any]]]:
+        """Cached messages at this version, or None"""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        if entry[0] != version:
+            self.discard(user_id)
+            return None
+        
+        self._entries.move_to_end(user_id)
+        return list(entry[1])
+    
+    def put(self, user_id: int, version: int, messages: List[Dict[str, Any]]) -> None:
+        """Cache a user's messages as read at a version"""
+        self._store(user_id, version, list(messages), [self._size(message) for message in messages])
+    
+    def _store(self, user_id: int, version: int, messages: List[Dict[str, Any]], sizes: List[int]) -> None:
+        self.discard(user_id)
+        if sum(sizes) > self.max_bytes:
+            return
+        
+        self._entries[user_id] = (version, messages, sizes)
+        self.bytes += sum(sizes)
+        self._evict()
+    
+    def append(self, user_id: int, previous_version: int, version: int, message: Dict[str, Any], keep: Optional[int]) -> None:
+        """Apply an append the database made at previous_version, or drop an entry that missed other changes"""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return
+        if entry[0] != previous_version:
+            self.discard(user_id)
+            return
+        
+        messages = entry[1] + [message]
+        sizes = entry[2] + [self._size(message)]
+        if keep is not None:
+            messages, sizes = messages[-keep:], sizes[-keep:]
+        self._store(user_id, version, messages, sizes)
+    
+    def discard(self, user_id: int) -> None:
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self.bytes -= sum(entry[2])
+    
+    def _evict(self) -> None:
+        """Drop least recently used entries until within budget"""
+        while self.bytes > self.max_bytes and self._entries:
+            user_id = next(iter(self._entries))
+            self.discard(user_id)
+
 class DatabaseManager:
     def __init__(self):
-        self.supabase: Client = create_client(
-            Config.SUPABASE_URL,
-            Config.SUPABASE_SERVICE_ROLE_KEY
-        )
-        self._init_tables()
-    
-    def _init_tables(self):
-        """Initialize database tables if they don't exist"""
+        self._client: Optional[Client] = None
+        self._verified = False
+        self.usage = UsageLedger(Config.USAGE_JOURNAL_DIR)
+        self._flush_task: Optional[asyncio.Task] = None
+        self._usage_events: List[Dict[str, Any]] = []
+        self.context_cache = ContextCache(Config.CONTEXT_CACHE_MAX_BYTES)
+    
+    @property
+    def supabase(self) -> Client:
+        """Supabase client, created on first use"""
+        if self._client is None:
+            self._client = create_client(
+                Config.SUPABASE_URL,
+                Config.SUPABASE_SERVICE_ROLE_KEY
+            )
+        return self._client
+    
+    async def initialize(self) -> None:
+        """Apply pending migrations and verify the schema once"""
+        if self._verified:
+            return
+        await migration_runner.run(self.supabase)
+        self._verified = True
+        
+        self.usage.open()
+        self._flush_task = asyncio.create_task(self._usage_flush_loop())
+    
+    async def close(self) -> None:
+        """Stop the flush loop and write out remaining usage"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        
+        await self.flush_usage()
+        self.usage.close()
+    
+    async def _usage_flush_loop(self) -> None:
+        """Flush usage deltas every USAGE_FLUSH_INTERVAL_MS"""
+        while True:
+            await asyncio.sleep(Config.USAGE_FLUSH_INTERVAL_MS / 1000)
+            await self.flush_usage()
+    
+    async def flush_usage(self) -> None:
+        """Apply each pending usage batch with a single statement"""
+        self.usage.rotate()
+        today = datetime.now().date().isoformat()
+        
+        for batch_id, deltas in self.usage.batches():
+            try:
+                await asyncio.to_thread(
+                    lambda: self.supabase.rpc('apply_usage_deltas', {
+                        'p_batch_id': batch_id,
+                        'p_deltas': [
+                            {'user_id': user_id, 'count': count, 'tokens': tokens}
+                            for user_id, (count, tokens) in deltas.items()
+                        ],
+                        'p_today': today
+                    }).execute()
+                )
+                self.usage.confirm(batch_id)
+            except Exception as e:
+                # Keep the batch and its id; the next flush retries it
+                logger.error(f"Error flushing usage batch {batch_id}: {e}")
+                break
+        
+        await self._flush_usage_events()
+    
+    async def _flush_usage_events(self) -> None:
+        """Insert buffered usage events with a single statement"""
+        if not self._usage_events:
+            return
+        
+        events, self._usage_events = self._usage_events, []
         try:
-            # Check if tables exist by trying to query them
-            # If they don't exist, the user needs to create them manually in Supabase
-            self.supabase.table('users').select('*').limit(1).execute()
-            self.supabase.table('user_context').select('*').limit(1).execute()
-            self.supabase.table('payments').select('*').limit(1).execute()
-            logger.info("Database tables verified successfully")
-            
+            await asyncio.to_thread(lambda: self.supabase.table('usage_events').insert(events).execute())
         except Exception as e:
-            logger.error(f"Database tables not found. Please run the setup_database.sql script in your Supabase dashboard: {e}")
-            logger.error("Go to Supabase Dashboard → SQL Editor → Run setup_database.sql")
+            logger.error(f"Error inserting {len(events)} usage events: {e}")
+            # Keep a bounded backlog for the next flush instead of growing without limit
+            self._usage_events = (events + self._usage_events)[-Config.USAGE_EVENTS_BACKLOG:]
     
     async def get_user_data(self, user_id: int) -> Dict[str, Any]:
         """Get user data, create if doesn't exist"""
@@ -35,10 +277,7 @@ class DatabaseManager:
             response = self.supabase.table('users').select('*').eq('user_id', user_id).execute()
             
             if response.data:
-                user_data = response.data[0]
-                # Check if we need to reset counters
-                await self._check_and_reset_counters(user_data)
-                return user_data
+                return response.data[0]
             else:
                 # Create new user
                 new_user = {
@@ -58,29 +297,39 @@ class DatabaseManager:
             logger.error(f"Error getting user data: {e}")
             return None
     
-    async def _check_and_reset_counters(self, user_data: Dict[str, Any]) -> None:
-        """Check and reset daily/monthly counters if needed"""
-        try:
-            user_id = user_data['user_id']
-            today = datetime.now().date()
-            
-            updates = {}
-            
-            # Check daily reset
-            if user_data['last_daily_reset'] != today:
-                updates['daily_count'] = 0
-                updates['last_daily_reset'] = today.isoformat()
-            
-            # Check monthly reset
-            last_monthly_reset = datetime.fromisoformat(user_data['last_monthly_reset']).date()
-            if last_monthly_reset.month != today.month:
-                updates['monthly_count'] = 0
-                updates['last_monthly_reset'] = today.isoformat()
-            
-            if updates:
-                self.supabase.table('users').update(updates).eq('user_id', user_id).execute()
-        except Exception as e:
-            logger.error(f"Error resetting counters: {e}")
+    def _effective_counts(self, user_data: Dict[str, Any]) -> Dict[str, int]:
+        """Return counters after pending resets, including increments not yet flushed"""
+        today = datetime.now().date()
+        daily_count = user_data['daily_count']
+        monthly_count = user_data['monthly_count']
+        daily_tokens = user_data.get('daily_tokens') or 0
+        monthly_tokens = user_data.get('monthly_tokens') or 0
+        
+        # The maintenance job may not have run yet right after a window boundary
+        if user_data['last_daily_reset'] < today.isoformat():
+            daily_count = daily_tokens = 0
+        if user_data['last_monthly_reset'] < today.replace(day=1).isoformat():
+            monthly_count = monthly_tokens = 0
+        
+        unflushed_count, unflushed_tokens = self.usage.unflushed(user_data['user_id'])
+        
+        return {
+            'daily_count': daily_count + unflushed_count,
+            'monthly_count': monthly_count + unflushed_count,
+            'daily_tokens': daily_tokens + unflushed_tokens,
+            'monthly_tokens': monthly_tokens + unflushed_tokens
+        }
+    
+    @staticmethod
+    def _within_limits(counts: Dict[str, int], limits: Dict[str, Any]) -> bool:
+        """Check counters against message limits and any configured token limits"""
+        if counts['daily_count'] >= limits['daily'] or counts['monthly_count'] >= limits['monthly']:
+            return False
+        if limits.get('daily_tokens') is not None and counts['daily_tokens'] >= limits['daily_tokens']:
+            return False
+        if limits.get('monthly_tokens') is not None and counts['monthly_tokens'] >= limits['monthly_tokens']:
+            return False
+        return True
     
     async def can_send_message(self, user_id: int) -> bool:
         """Check if user can send a message"""
@@ -90,8 +339,7 @@ class DatabaseManager:
                 return False
             
             limits = Config.USAGE_LIMITS[user_data['tier']]
-            return (user_data['daily_count'] < limits['daily'] and 
-                   user_data['monthly_count'] < limits['monthly'])
+            return self._within_limits(self._effective_counts(user_data), limits)
         except Exception as e:
             logger.error(f"Error checking message limits: {e}")
             return False
@@ -99,24 +347,56 @@ class DatabaseManager:
     async def increment_message_count(self, user_id: int) -> None:
         """Increment user's message count"""
         try:
-            user_data = await self.get_user_data(user_id)
-            if user_data:
-                self.supabase.table('users').update({
-                    'daily_count': user_data['daily_count'] + 1,
-                    'monthly_count': user_data['monthly_count'] + 1
-                }).eq('user_id', user_id).execute()
+            self.usage.add(user_id)
         except Exception as e:
             logger.error(f"Error incrementing message count: {e}")
     
-    async def get_context(self, user_id: int, limit: int = None) -> List[Dict[str, Any]]:
-        """Get user's conversation context"""
+    async def record_usage(self, user_id: int, result: CompletionResult, kind: str = 'chat') -> None:
+        """Buffer a usage event and, for chat requests, charge its tokens to the user"""
         try:
-            if limit is None:
+            if kind == 'chat' and result.total_tokens:
+                self.usage.add(user_id, count=0, tokens=result.total_tokens)
+            
+            self._usage_events.append({
+                'user_id': user_id,
+                'kind': kind,
+                'model': result.model,
+                'generation_id': result.generation_id,
+                'prompt_tokens': result.prompt_tokens,
+                'completion_tokens': result.completion_tokens,
+                'cached_tokens': result.cached_tokens,
+                'cost': result.cost,
+                'latency_ms': result.latency_ms,
+                'success': result.ok
+            })
+        except Exception as e:
+            logger.error(f"Error recording usage: {e}")
+    
+    async def get_context(self, user_id: int, limit: int = None, version: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Get user's conversation context, from the cache when it is at the given context version"""
+        try:
+            cacheable = version is not None and limit is None
+            if cacheable:
+                cached = self.context_cache.get(user_id, version)
+                if cached is not None:
+                    return cached
+            
+            query = self.supabase.table('user_context').select('role, content').eq('user_id', user_id).order('created_at', desc=False)
+            
+            # With compaction the summary keeps the context bounded, so every row is replayed
+            if limit is None and not Config.CONTEXT_COMPACTION:
                 limit = Config.CONTEXT_SIZE
+            if limit is not None:
+                query = query.limit(limit)
+            
+            response = query.execute()
             
-            response = self.supabase.table('user_context').select('*').eq('user_id', user_id).order('created_at', desc=False).limit(limit).execute()
+            messages = [{'role': item['role'], 'content': item['content']} for item in response.data]
             
-            return [{'role': item['role'], 'content': item['content']} for item in response.data]
+            # Rows written after the version was read only make this entry miss on the next read
+            if cacheable:
+                self.context_cache.put(user_id, version, messages)
+            return messages
         except Exception as e:
             logger.error(f"Error getting context: {e}")
             return []
@@ -127,26 +407,53 @@ class DatabaseManager:
             # First increment message count
             await self.increment_message_count(user_id)
             
-            # Add to context
-            self.supabase.table('user_context').insert({
-                'user_id': user_id,
-                'role': role,
-                'content': content
+            # Add to context and keep only the last N messages; compaction replaces
+            # old messages with a summary instead of dropping them
+            keep = None if Config.CONTEXT_COMPACTION else Config.CONTEXT_SIZE
+            response = self.supabase.rpc('append_context', {
+                'p_user_id': user_id,
+                'p_role': role,
+                'p_content': content,
+                'p_keep': keep
             }).execute()
             
-            # Keep only last N messages
-            messages = self.supabase.table('user_context').select('id').eq('user_id', user_id).order('created_at', desc=True).execute()
-            
-            if len(messages.data) > Config.CONTEXT_SIZE:
-                ids_to_delete = [msg['id'] for msg in messages.data[Config.CONTEXT_SIZE:]]
-                self.supabase.table('user_context').delete().in_('id', ids_to_delete).execute()
-                
+            self.context_cache.append(
+                user_id,
+                response.data['previous_version'],
+                response.data['version'],
+                {'role': role, 'content': content},
+                keep
+            )
         except Exception as e:
             logger.error(f"Error adding message to context: {e}")
     
+    async def get_context_rows(self, user_id: int) -> List[Dict[str, Any]]:
+        """Get user's full context rows, oldest first"""
+        try:
+            response = self.supabase.table('user_context').select('id, role, content').eq('user_id', user_id).order('created_at', desc=False).execute()
+            return response.data
+        except Exception as e:
+            logger.error(f"Error getting context rows: {e}")
+            return []
+    
+    async def compact_context(self, user_id: int, ids: List[int], summary: Any) -> bool:
+        """Replace the given context rows with a single summary message"""
+        try:
+            response = self.supabase.rpc('compact_context', {
+                'p_user_id': user_id,
+                'p_ids': ids,
+                'p_summary': summary
+            }).execute()
+            self.context_cache.discard(user_id)
+            return bool(response.data)
+        except Exception as e:
+            logger.error(f"Error compacting context: {e}")
+            return False
+    
     async def reset_context(self, user_id: int) -> None:
         """Reset user's conversation context"""
         try:
+            self.context_cache.discard(user_id)
             self.supabase.table('user_context').delete().eq('user_id', user_id).execute()
         except Exception as e:
             logger.error(f"Error resetting context: {e}")
@@ -194,7 +501,7 @@ class DatabaseManager:
             if not user_data:
                 return False
             
-            available_models = Config.AVAILABLE_MODELS[user_data['tier']]
+            available_models = [Config.AUTO_MODEL] + Config.AVAILABLE_MODELS[user_data['tier']]
             if model in available_models:
                 self.supabase.table('users').update({
                     'current_model': model
@@ -208,16 +515,16 @@ class DatabaseManager:
             return False
     
     async def get_available_models(self, user_id: int) -> List[str]:
-        """Get available models for user's tier"""
+        """Get available models for user's tier, with automatic routing first"""
         try:
             user_data = await self.get_user_data(user_id)
             if not user_data:
-                return Config.AVAILABLE_MODELS['lite']
+                return [Config.AUTO_MODEL] + Config.AVAILABLE_MODELS['lite']
             
-            return Config.AVAILABLE_MODELS[user_data['tier']]
+            return [Config.AUTO_MODEL] + Config.AVAILABLE_MODELS[user_data['tier']]
         except Exception as e:
             logger.error(f"Error getting available models: {e}")
-            return Config.AVAILABLE_MODELS['lite']
+            return [Config.AUTO_MODEL] + Config.AVAILABLE_MODELS['lite']
     
     async def get_user_profile(self, user_id: int) -> Dict[str, Any]:
         """Get user's profile information"""
@@ -227,49 +534,166 @@ class DatabaseManager:
                 return {}
             
             limits = Config.USAGE_LIMITS[user_data['tier']]
+            counts = self._effective_counts(user_data)
             
             return {
                 'user_id': user_id,
                 'tier': user_data['tier'],
                 'subscription_end_date': user_data.get('subscription_end_date'),
-                'daily_remaining': limits['daily'] - user_data['daily_count'],
-                'monthly_remaining': limits['monthly'] - user_data['monthly_count'],
+                'daily_remaining': limits['daily'] - counts['daily_count'],
+                'monthly_remaining': limits['monthly'] - counts['monthly_count'],
+                'daily_tokens_remaining': limits['daily_tokens'] - counts['daily_tokens'] if limits.get('daily_tokens') is not None else None,
+                'monthly_tokens_remaining': limits['monthly_tokens'] - counts['monthly_tokens'] if limits.get('monthly_tokens') is not None else None,
                 'current_model': user_data['current_model']
             }
         except Exception as e:
             logger.error(f"Error getting user profile: {e}")
             return {}
     
-    async def upgrade_to_plus(self, user_id: int, subscription_end_date: datetime) -> bool:
-        """Upgrade user to Plus tier"""
+    async def fulfil_plus_payment(self, user_id: int, charge_id: str, amount: int, currency: str, days: int) -> Optional[Dict[str, Any]]:
+        """Record a payment and upgrade the user to Plus, once per charge id"""
         try:
-            updates = {
-                'tier': 'plus',
-                'subscription_end_date': subscription_end_date.isoformat(),
-                'daily_count': 0,
-                'monthly_count': 0,
-                'last_daily_reset': datetime.now().date().isoformat(),
-                'last_monthly_reset': datetime.now().date().isoformat()
-            }
+            response = self.supabase.rpc('fulfil_plus_payment', {
+                'p_user_id': user_id,
+                'p_charge_id': charge_id,
+                'p_amount': amount,
+                'p_currency': currency,
+                'p_days': days,
+                'p_today': datetime.now().date().isoformat()
+            }).execute()
+            return response.data
+        except Exception as e:
+            logger.error(f"Error fulfilling payment {charge_id}: {e}")
+            return None
+    
+    async def reset_daily_counters(self) -> None:
+        """Reset daily counters for every user whose window has ended"""
+        try:
+            today = datetime.now().date().isoformat()
+            await asyncio.to_thread(
+                lambda: self.supabase.table('users').update({
+                    'daily_count': 0,
+                    'daily_tokens': 0,
+                    'last_daily_reset': today
+                }).lt('last_daily_reset', today).execute()
+            )
+        except Exception as e:
+            logger.error(f"Error resetting daily counters: {e}")
+    
+    async def reset_monthly_counters(self) -> None:
+        """Reset monthly counters for every user whose window has ended"""
+        try:
+            today = datetime.now().date()
+            await asyncio.to_thread(
+                lambda: self.supabase.table('users').update({
+                    'monthly_count': 0,
+                    'monthly_tokens': 0,
+                    'last_monthly_reset': today.isoformat()
+                }).lt('last_monthly_reset', today.replace(day=1).isoformat()).execute()
+            )
+        except Exception as e:
+            logger.error(f"Error resetting monthly counters: {e}")
+    
+    async def expire_subscriptions(self) -> None:
+        """Downgrade Plus users whose subscription has ended"""
+        try:
+            now = datetime.now().isoformat()
+            lite_models = Config.AVAILABLE_MODELS['lite']
             
-            self.supabase.table('users').update(updates).eq('user_id', user_id).execute()
-            return True
+            # Move expired users off Plus-only models before changing their tier
+            await asyncio.to_thread(
+                lambda: self.supabase.table('users').update({
+                    'current_model': lite_models[0]
+                }).eq('tier', 'plus').lt('subscription_end_date', now).not_.in_('current_model', lite_models + [Config.AUTO_MODEL]).execute()
+            )
+            
+            await asyncio.to_thread(
+                lambda: self.supabase.table('users').update({
+                    'tier': 'lite'
+                }).eq('tier', 'plus').lt('subscription_end_date', now).execute()
+            )
         except Exception as e:
-            logger.error(f"Error upgrading to plus: {e}")
-            return False
+            logger.error(f"Error expiring subscriptions: {e}")
     
-    async def record_payment(self, user_id: int, charge_id: str, amount: int, currency: str) -> None:
-        """Record a successful payment"""
+    async def purge_stale_context(self) -> None:
+        """Delete context messages older than the retention period"""
         try:
-            self.supabase.table('payments').insert({
-                'user_id': user_id,
-                'telegram_payment_charge_id': charge_id,
-                'amount': amount,
-                'currency': currency,
-                'status': 'completed'
-            }).execute()
+            if Config.CONTEXT_RETENTION_DAYS <= 0:
+                return
+            
+            cutoff = datetime.now() - timedelta(days=Config.CONTEXT_RETENTION_DAYS)
+            await asyncio.to_thread(lambda: self.supabase.table('user_context').delete().lt('created_at', cutoff.isoformat()).execute())
+        except Exception as e:
+            logger.error(f"Error purging stale context: {e}")
+    
+    async def purge_usage_events(self) -> None:
+        """Delete usage events older than the retention period"""
+        try:
+            if Config.USAGE_EVENTS_RETENTION_DAYS <= 0:
+                return
+            
+            cutoff = datetime.now() - timedelta(days=Config.USAGE_EVENTS_RETENTION_DAYS)
+            await asyncio.to_thread(lambda: self.supabase.table('usage_events').delete().lt('created_at', cutoff.isoformat()).execute())
         except Exception as e:
-            logger.error(f"Error recording payment: {e}")
+            logger.error(f"Error purging usage events: {e}")
+    
+    async def purge_usage_batches(self) -> None:
+        """Delete applied usage batch ids once retries for them can no longer arrive"""
+        try:
+            cutoff = datetime.now() - timedelta(days=1)
+            await asyncio.to_thread(lambda: self.supabase.table('usage_batches').delete().lt('applied_at', cutoff.isoformat()).execute())
+        except Exception as e:
+            logger.error(f"Error purging usage batches: {e}")
+    
+    async def save_inflight_requests(self, requests: List[Dict[str, Any]]) -> None:
+        """Checkpoint requests that could not finish before shutdown"""
+        if not requests:
+            return
+        try:
+            self.supabase.table('inflight_requests').insert(requests).execute()
+        except Exception as e:
+            logger.error(f"Error saving in-flight requests: {e}")
+    
+    async def claim_inflight_requests(self, shard: int, shards: int, limit: int = 1000) -> List[Dict[str, Any]]:
+        """Take the requests checkpointed by stopped instances for users of one shard"""
+        try:
+            response = self.supabase.rpc(
+                'claim_inflight_requests',
+                {'p_limit': limit, 'p_shards': shards, 'p_shard': shard}
+            ).execute()
+            return response.data or []
+        except Exception as e:
+            logger.error(f"Error claiming in-flight requests: {e}")
+            return []
+    
+    async def claim_update_keys(self, keys: List[str]) -> bool:
+        """Claim update keys in the shared table; False if another instance had them"""
+        try:
+            response = self.supabase.rpc('claim_update_keys', {'p_keys': keys}).execute()
+            return bool(response.data)
+        except Exception as e:
+            # Better to risk a duplicate than to drop an update
+            logger.error(f"Error claiming update keys: {e}")
+            return True
+    
+    async def purge_processed_updates(self) -> None:
+        """Delete claimed update keys that fell out of the dedupe window"""
+        try:
+            cutoff = datetime.now() - timedelta(seconds=Config.DEDUPE_WINDOW_SECONDS)
+            await asyncio.to_thread(lambda: self.supabase.table('processed_updates').delete().lt('created_at', cutoff.isoformat()).execute())
+        except Exception as e:
+            logger.error(f"Error purging processed updates: {e}")
+    
+    async def run_maintenance(self) -> None:
+        """Run all bulk maintenance statements in worker threads, so updates and heartbeats keep flowing"""
+        await self.reset_daily_counters()
+        await self.reset_monthly_counters()
+        await self.expire_subscriptions()
+        await self.purge_stale_context()
+        await self.purge_usage_batches()
+        await self.purge_usage_events()
+        if Config.DEDUPE_SHARED:
+            await self.purge_processed_updates()
 
 # Global database instance
 db = DatabaseManager()
\ No newline at end of file
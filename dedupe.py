@@ -0,0 +1,80 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import List
+from telegram import Update
+from config import Config
+from database import db
+
+logger = logging.getLogger(__name__)
+
+class UpdateDeduplicator:
+    """Bounded window of recently seen updates, used to drop redeliveries.
+    
+    Updates are keyed by update_id and, for new messages, by (chat, message_id).
+    With DEDUPE_SHARED the keys are also claimed in Postgres so that several
+    instances agree on which one handles an update.
+    """
+    
+    def __init__(self, window_seconds: int, max_entries: int):
+        self.window_seconds = window_seconds
+        self.max_entries = max_entries
+        self._seen: "OrderedDict[str, float]" = OrderedDict()
+    
+    @staticmethod
+    def keys(update: Update) -> List[str]:
+        """Identities under which an update may be redelivered"""
+        keys = [f"u:{update.update_id}"]
+        if update.message:
+            keys.append(f"m:{update.message.chat_id}:{update.message.message_id}")
+        if update.callback_query:
+            keys.append(f"c:{update.callback_query.id}")
+        return keys
+    
+    @staticmethod
+    def needs_shared_check(update: Update) -> bool:
+        """Only updates that lead to database or model work are claimed in Postgres"""
+        # Answering a pre-checkout query again is harmless, and it has to be answered quickly
+        if update.callback_query:
+            return True
+        message = update.message
+        if message is None:
+            return False
+        if message.successful_payment:
+            return True
+        text = message.text or message.caption or ""
+        return text.startswith("/")
+    
+    def _evict(self, now: float) -> None:
+        """Drop entries outside the window or over capacity, oldest first"""
+        cutoff = now - self.window_seconds
+        while self._seen:
+            key, seen_at = next(iter(self._seen.items()))
+            if seen_at >= cutoff and len(self._seen) <= self.max_entries:
+                break
+            self._seen.popitem(last=False)
+    
+    def seen_locally(self, keys: List[str]) -> bool:
+        """Check keys against the local window and remember them"""
+        now = time.monotonic()
+        self._evict(now)
+        
+        if any(key in self._seen for key in keys):
+            return True
+        
+        for key in keys:
+            self._seen[key] = now
+        return False
+    
+    async def is_duplicate(self, update: Update) -> bool:
+        """Check whether this update has already been handled"""
+        keys = self.keys(update)
+        if self.seen_locally(keys):
+            return True
+        
+        if Config.DEDUPE_SHARED and self.needs_shared_check(update):
+            return not await db.claim_update_keys(keys)
+        return False
+
+# Global update deduplicator instance
+update_deduplicator = UpdateDeduplicator(Config.DEDUPE_WINDOW_SECONDS, Config.DEDUPE_MAX_ENTRIES)
@@ -35,7 +35,16 @@ CREATE TABLE IF NOT EXISTS public.payments (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Create schema_migrations table (applied versions, maintained by schema.py)
+CREATE TABLE IF NOT EXISTS public.schema_migrations (
+    version INTEGER PRIMARY KEY,
+    name VARCHAR(255) NOT NULL,
+    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
 -- Grant necessary permissions
 GRANT USAGE ON SCHEMA public TO authenticated, anon;
 GRANT ALL ON ALL TABLES IN SCHEMA public TO authenticated, anon;
-GRANT ALL ON ALL SEQUENCES IN SCHEMA public TO authenticated, anon;
\ No newline at end of file
+GRANT ALL ON ALL SEQUENCES IN SCHEMA public TO authenticated, anon;
+
+INSERT INTO public.schema_migrations (version, name) VALUES (1, 'initial') ON CONFLICT (version) DO NOTHING;
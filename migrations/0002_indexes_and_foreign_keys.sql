@@ -0,0 +1,30 @@
+-- Serve get_context and the context trim query from an index instead of a sequential scan
+CREATE INDEX IF NOT EXISTS user_context_user_id_created_at_idx
+    ON public.user_context (user_id, created_at)
+    INCLUDE (id, role);
+
+-- Look up payments by user
+CREATE INDEX IF NOT EXISTS payments_user_id_idx
+    ON public.payments (user_id);
+
+-- Find expired subscriptions without scanning every user
+CREATE INDEX IF NOT EXISTS users_plus_subscription_end_date_idx
+    ON public.users (subscription_end_date)
+    WHERE tier = 'plus';
+
+-- Drop context rows that belong to no user before adding the foreign key
+DELETE FROM public.user_context c
+WHERE NOT EXISTS (SELECT 1 FROM public.users u WHERE u.user_id = c.user_id);
+
+ALTER TABLE public.user_context
+    DROP CONSTRAINT IF EXISTS user_context_user_id_fkey,
+    ADD CONSTRAINT user_context_user_id_fkey
+        FOREIGN KEY (user_id) REFERENCES public.users (user_id) ON DELETE CASCADE;
+
+-- Payments are financial records: never delete them together with a user
+ALTER TABLE public.payments
+    DROP CONSTRAINT IF EXISTS payments_user_id_fkey,
+    ADD CONSTRAINT payments_user_id_fkey
+        FOREIGN KEY (user_id) REFERENCES public.users (user_id) ON DELETE RESTRICT;
+
+INSERT INTO public.schema_migrations (version, name) VALUES (2, 'indexes_and_foreign_keys') ON CONFLICT (version) DO NOTHING;
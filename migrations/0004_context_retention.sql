@@ -0,0 +1,5 @@
+-- Let the retention purge in the maintenance job delete old context by range
+CREATE INDEX IF NOT EXISTS user_context_created_at_idx
+    ON public.user_context (created_at);
+
+INSERT INTO public.schema_migrations (version, name) VALUES (4, 'context_retention') ON CONFLICT (version) DO NOTHING;
@@ -0,0 +1,27 @@
+-- Batches of usage deltas already applied, so a retried flush is never counted twice
+CREATE TABLE IF NOT EXISTS public.usage_batches (
+    batch_id UUID PRIMARY KEY,
+    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Apply aggregated message counts for many users in one statement.
+-- p_deltas is a JSON array of {"user_id": ..., "count": ...} objects.
+CREATE OR REPLACE FUNCTION public.apply_usage_deltas(p_batch_id UUID, p_deltas JSONB, p_today DATE)
+RETURNS VOID AS $$
+BEGIN
+    INSERT INTO public.usage_batches (batch_id) VALUES (p_batch_id) ON CONFLICT (batch_id) DO NOTHING;
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+
+    UPDATE public.users u
+    SET daily_count = CASE WHEN u.last_daily_reset < p_today THEN 0 ELSE u.daily_count END + d.count,
+        monthly_count = CASE WHEN u.last_monthly_reset < date_trunc('month', p_today)::DATE THEN 0 ELSE u.monthly_count END + d.count,
+        last_daily_reset = CASE WHEN u.last_daily_reset < p_today THEN p_today ELSE u.last_daily_reset END,
+        last_monthly_reset = CASE WHEN u.last_monthly_reset < date_trunc('month', p_today)::DATE THEN p_today ELSE u.last_monthly_reset END
+    FROM jsonb_to_recordset(p_deltas) AS d(user_id BIGINT, count INTEGER)
+    WHERE u.user_id = d.user_id;
+END;
+$$ LANGUAGE plpgsql;
+
+INSERT INTO public.schema_migrations (version, name) VALUES (5, 'usage_batches') ON CONFLICT (version) DO NOTHING;
@@ -0,0 +1,21 @@
+-- Replace older context messages with a single summary row, atomically.
+-- Does nothing if any of the rows were removed in the meantime (e.g. by /resetcontext).
+CREATE OR REPLACE FUNCTION public.compact_context(p_user_id BIGINT, p_ids BIGINT[], p_summary JSONB)
+RETURNS BOOLEAN AS $$
+BEGIN
+    INSERT INTO public.user_context (user_id, role, content, created_at)
+    SELECT p_user_id, 'system', p_summary, MIN(created_at)
+    FROM public.user_context
+    WHERE user_id = p_user_id AND id = ANY(p_ids)
+    HAVING COUNT(*) = cardinality(p_ids);
+
+    IF NOT FOUND THEN
+        RETURN FALSE;
+    END IF;
+
+    DELETE FROM public.user_context WHERE user_id = p_user_id AND id = ANY(p_ids);
+    RETURN TRUE;
+END;
+$$ LANGUAGE plpgsql;
+
+INSERT INTO public.schema_migrations (version, name) VALUES (6, 'compact_context') ON CONFLICT (version) DO NOTHING;
@@ -0,0 +1,50 @@
+-- Token counters for token-based quotas
+ALTER TABLE public.users
+    ADD COLUMN IF NOT EXISTS daily_tokens BIGINT DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS monthly_tokens BIGINT DEFAULT 0;
+
+-- Append-only log of every completion: tokens, cost and latency per user and model
+CREATE TABLE IF NOT EXISTS public.usage_events (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    kind VARCHAR(50) NOT NULL DEFAULT 'chat',
+    model VARCHAR(255) NOT NULL,
+    generation_id VARCHAR(255),
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    completion_tokens INTEGER NOT NULL DEFAULT 0,
+    cached_tokens INTEGER NOT NULL DEFAULT 0,
+    cost NUMERIC(12, 6) NOT NULL DEFAULT 0,
+    latency_ms INTEGER NOT NULL DEFAULT 0,
+    success BOOLEAN NOT NULL DEFAULT TRUE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS usage_events_user_id_created_at_idx
+    ON public.usage_events (user_id, created_at);
+
+CREATE INDEX IF NOT EXISTS usage_events_model_created_at_idx
+    ON public.usage_events (model, created_at);
+
+-- Usage deltas now carry tokens as well as message counts.
+-- p_deltas is a JSON array of {"user_id": ..., "count": ..., "tokens": ...} objects.
+CREATE OR REPLACE FUNCTION public.apply_usage_deltas(p_batch_id UUID, p_deltas JSONB, p_today DATE)
+RETURNS VOID AS $$
+BEGIN
+    INSERT INTO public.usage_batches (batch_id) VALUES (p_batch_id) ON CONFLICT (batch_id) DO NOTHING;
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+
+    UPDATE public.users u
+    SET daily_count = CASE WHEN u.last_daily_reset < p_today THEN 0 ELSE u.daily_count END + d.count,
+        monthly_count = CASE WHEN u.last_monthly_reset < date_trunc('month', p_today)::DATE THEN 0 ELSE u.monthly_count END + d.count,
+        daily_tokens = CASE WHEN u.last_daily_reset < p_today THEN 0 ELSE u.daily_tokens END + COALESCE(d.tokens, 0),
+        monthly_tokens = CASE WHEN u.last_monthly_reset < date_trunc('month', p_today)::DATE THEN 0 ELSE u.monthly_tokens END + COALESCE(d.tokens, 0),
+        last_daily_reset = CASE WHEN u.last_daily_reset < p_today THEN p_today ELSE u.last_daily_reset END,
+        last_monthly_reset = CASE WHEN u.last_monthly_reset < date_trunc('month', p_today)::DATE THEN p_today ELSE u.last_monthly_reset END
+    FROM jsonb_to_recordset(p_deltas) AS d(user_id BIGINT, count INTEGER, tokens BIGINT)
+    WHERE u.user_id = d.user_id;
+END;
+$$ LANGUAGE plpgsql;
+
+INSERT INTO public.schema_migrations (version, name) VALUES (7, 'usage_events_and_token_quotas') ON CONFLICT (version) DO NOTHING;
@@ -0,0 +1,25 @@
+-- Update keys already claimed by an instance, for duplicate suppression across instances
+CREATE TABLE IF NOT EXISTS public.processed_updates (
+    key VARCHAR(255) PRIMARY KEY,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS processed_updates_created_at_idx
+    ON public.processed_updates (created_at);
+
+-- Claim all keys of an update; returns FALSE if any of them was claimed before
+CREATE OR REPLACE FUNCTION public.claim_update_keys(p_keys TEXT[])
+RETURNS BOOLEAN AS $$
+DECLARE
+    claimed INTEGER;
+BEGIN
+    INSERT INTO public.processed_updates (key)
+    SELECT unnest(p_keys)
+    ON CONFLICT (key) DO NOTHING;
+
+    GET DIAGNOSTICS claimed = ROW_COUNT;
+    RETURN claimed = cardinality(p_keys);
+END;
+$$ LANGUAGE plpgsql;
+
+INSERT INTO public.schema_migrations (version, name) VALUES (8, 'processed_updates') ON CONFLICT (version) DO NOTHING;
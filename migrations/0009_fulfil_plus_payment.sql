@@ -0,0 +1,50 @@
+-- Record a Plus payment and upgrade the user in one transaction.
+-- Idempotent on telegram_payment_charge_id: a repeated call changes nothing
+-- and reports newly_fulfilled = false.
+CREATE OR REPLACE FUNCTION public.fulfil_plus_payment(
+    p_user_id BIGINT,
+    p_charge_id VARCHAR,
+    p_amount INTEGER,
+    p_currency VARCHAR,
+    p_days INTEGER,
+    p_today DATE
+)
+RETURNS JSONB AS $$
+DECLARE
+    inserted INTEGER;
+    end_date TIMESTAMP;
+BEGIN
+    INSERT INTO public.users (user_id) VALUES (p_user_id) ON CONFLICT (user_id) DO NOTHING;
+
+    INSERT INTO public.payments (user_id, telegram_payment_charge_id, amount, currency, status)
+    VALUES (p_user_id, p_charge_id, p_amount, p_currency, 'completed')
+    ON CONFLICT (telegram_payment_charge_id) DO NOTHING;
+    GET DIAGNOSTICS inserted = ROW_COUNT;
+
+    IF inserted > 0 THEN
+        -- Renewing an active subscription extends it instead of restarting it
+        UPDATE public.users
+        SET tier = 'plus',
+            subscription_end_date = CASE
+                WHEN tier = 'plus' AND subscription_end_date > LOCALTIMESTAMP THEN subscription_end_date
+                ELSE LOCALTIMESTAMP
+            END + make_interval(days => p_days),
+            daily_count = 0,
+            monthly_count = 0,
+            daily_tokens = 0,
+            monthly_tokens = 0,
+            last_daily_reset = p_today,
+            last_monthly_reset = p_today
+        WHERE user_id = p_user_id;
+    END IF;
+
+    SELECT subscription_end_date INTO end_date FROM public.users WHERE user_id = p_user_id;
+
+    RETURN jsonb_build_object(
+        'subscription_end_date', end_date,
+        'newly_fulfilled', inserted > 0
+    );
+END;
+$$ LANGUAGE plpgsql;
+
+INSERT INTO public.schema_migrations (version, name) VALUES (9, 'fulfil_plus_payment') ON CONFLICT (version) DO NOTHING;
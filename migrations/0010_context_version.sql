@@ -0,0 +1,64 @@
+-- Version counter of each user's context, bumped by every change to their
+-- user_context rows so that cached copies can be checked for staleness.
+ALTER TABLE public.users ADD COLUMN IF NOT EXISTS context_version BIGINT NOT NULL DEFAULT 0;
+
+CREATE OR REPLACE FUNCTION public.bump_context_version()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE public.users
+    SET context_version = context_version + 1
+    WHERE user_id IN (SELECT DISTINCT user_id FROM changed_rows);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS user_context_inserted ON public.user_context;
+CREATE TRIGGER user_context_inserted
+    AFTER INSERT ON public.user_context
+    REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.bump_context_version();
+
+DROP TRIGGER IF EXISTS user_context_updated ON public.user_context;
+CREATE TRIGGER user_context_updated
+    AFTER UPDATE ON public.user_context
+    REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.bump_context_version();
+
+DROP TRIGGER IF EXISTS user_context_deleted ON public.user_context;
+CREATE TRIGGER user_context_deleted
+    AFTER DELETE ON public.user_context
+    REFERENCING OLD TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.bump_context_version();
+
+-- Append a context message and trim to the newest p_keep rows (no trim when NULL)
+-- in one call. Returns the context version before and after, so a caller whose
+-- cached copy is at previous_version can apply the same change locally.
+CREATE OR REPLACE FUNCTION public.append_context(p_user_id BIGINT, p_role VARCHAR, p_content JSONB, p_keep INTEGER)
+RETURNS JSONB AS $$
+DECLARE
+    previous_version BIGINT;
+    new_version BIGINT;
+BEGIN
+    INSERT INTO public.users (user_id) VALUES (p_user_id) ON CONFLICT (user_id) DO NOTHING;
+
+    -- Serializes concurrent appends for the user so the two versions are adjacent
+    SELECT context_version INTO previous_version FROM public.users WHERE user_id = p_user_id FOR UPDATE;
+
+    INSERT INTO public.user_context (user_id, role, content) VALUES (p_user_id, p_role, p_content);
+
+    IF p_keep IS NOT NULL THEN
+        DELETE FROM public.user_context
+        WHERE user_id = p_user_id AND id NOT IN (
+            SELECT id FROM public.user_context
+            WHERE user_id = p_user_id
+            ORDER BY created_at DESC, id DESC
+            LIMIT p_keep
+        );
+    END IF;
+
+    SELECT context_version INTO new_version FROM public.users WHERE user_id = p_user_id;
+    RETURN jsonb_build_object('previous_version', previous_version, 'version', new_version);
+END;
+$$ LANGUAGE plpgsql;
+
+INSERT INTO public.schema_migrations (version, name) VALUES (10, 'context_version') ON CONFLICT (version) DO NOTHING;
@@ -0,0 +1,27 @@
+-- Requests that an instance could not finish before shutting down. The next
+-- instance claims them on startup to resume them or tell the user.
+CREATE TABLE IF NOT EXISTS public.inflight_requests (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    chat_id BIGINT NOT NULL,
+    message_id BIGINT NOT NULL,
+    kind VARCHAR(20) NOT NULL,
+    query TEXT,
+    response TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Remove and return checkpointed requests, so each one is settled by a single instance
+CREATE OR REPLACE FUNCTION public.claim_inflight_requests(p_limit INTEGER)
+RETURNS SETOF public.inflight_requests AS $$
+    DELETE FROM public.inflight_requests
+    WHERE id IN (
+        SELECT id FROM public.inflight_requests
+        ORDER BY id
+        LIMIT p_limit
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING *;
+$$ LANGUAGE sql;
+
+INSERT INTO public.schema_migrations (version, name) VALUES (11, 'inflight_requests') ON CONFLICT (version) DO NOTHING;
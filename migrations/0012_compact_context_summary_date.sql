@@ -0,0 +1,22 @@
+-- Date the summary row by the newest message it replaces rather than the oldest,
+-- so the retention purge removes it together with those messages instead of
+-- before the newer turns it precedes. It still sorts before the kept rows.
+CREATE OR REPLACE FUNCTION public.compact_context(p_user_id BIGINT, p_ids BIGINT[], p_summary JSONB)
+RETURNS BOOLEAN AS $$
+BEGIN
+    INSERT INTO public.user_context (user_id, role, content, created_at)
+    SELECT p_user_id, 'system', p_summary, MAX(created_at)
+    FROM public.user_context
+    WHERE user_id = p_user_id AND id = ANY(p_ids)
+    HAVING COUNT(*) = cardinality(p_ids);
+
+    IF NOT FOUND THEN
+        RETURN FALSE;
+    END IF;
+
+    DELETE FROM public.user_context WHERE user_id = p_user_id AND id = ANY(p_ids);
+    RETURN TRUE;
+END;
+$$ LANGUAGE plpgsql;
+
+INSERT INTO public.schema_migrations (version, name) VALUES (12, 'compact_context_summary_date') ON CONFLICT (version) DO NOTHING;
@@ -0,0 +1,18 @@
+-- Claim only the checkpointed requests of one shard's users (user_id % shards),
+-- so a resumed request runs in the worker that receives that user's updates.
+DROP FUNCTION IF EXISTS public.claim_inflight_requests(INTEGER);
+
+CREATE OR REPLACE FUNCTION public.claim_inflight_requests(p_limit INTEGER, p_shards INTEGER, p_shard INTEGER)
+RETURNS SETOF public.inflight_requests AS $$
+    DELETE FROM public.inflight_requests
+    WHERE id IN (
+        SELECT id FROM public.inflight_requests
+        WHERE mod(user_id, p_shards) = p_shard
+        ORDER BY id
+        LIMIT p_limit
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING *;
+$$ LANGUAGE sql;
+
+INSERT INTO public.schema_migrations (version, name) VALUES (13, 'claim_inflight_requests_by_shard') ON CONFLICT (version) DO NOTHING;
@@ -1,11 +1,128 @@
 import aiohttp
 import asyncio
+import json
 import logging
-from typing import List, Dict, Any
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import List, Dict, Any, Optional, Iterator, AsyncIterator, Deque, Tuple
 from config import Config
+from utils import Attachment
 
 logger = logging.getLogger(__name__)
 
+class OpenRouterError(Exception):
+    """Raised when OpenRouter returns a non-success response"""
+
+@dataclass
+class CompletionResult:
+    """Completion text with the usage and timing OpenRouter reported for it"""
+    content: str
+    model: str
+    ok: bool = True
+    generation_id: Optional[str] = None
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_tokens: int = 0
+    cost: float = 0.0
+    latency_ms: int = 0
+    
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+# Size of the pieces a streamed request body is written in
+BODY_CHUNK_SIZE = 64 * 1024
+
+def iter_json(value: Any) -> Iterator[bytes]:
+    """Serialize a JSON value piece by piece, encoding attachments as data URLs in chunks"""
+    if isinstance(value, Attachment):
+        yield b'"'
+        yield from value.iter_data_url()
+        yield b'"'
+    elif isinstance(value, dict):
+        yield b"{"
+        for index, (key, item) in enumerate(value.items()):
+            if index:
+                yield b","
+            yield json.dumps(str(key)).encode("utf-8")
+            yield b":"
+            yield from iter_json(item)
+        yield b"}"
+    elif isinstance(value, (list, tuple)):
+        yield b"["
+        for index, item in enumerate(value):
+            if index:
+                yield b","
+            yield from iter_json(item)
+        yield b"]"
+    else:
+        yield json.dumps(value).encode("utf-8")
+
+def contains_attachment(value: Any) -> bool:
+    """Check whether a JSON value holds any attachment"""
+    if isinstance(value, Attachment):
+        return True
+    if isinstance(value, dict):
+        return any(contains_attachment(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return any(contains_attachment(item) for item in value)
+    return False
+
+async def stream_json(value: Any) -> AsyncIterator[bytes]:
+    """Stream a JSON value as a request body in chunks of about BODY_CHUNK_SIZE"""
+    buffer = bytearray()
+    for piece in iter_json(value):
+        buffer += piece
+        if len(buffer) >= BODY_CHUNK_SIZE:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+class ModelStats:
+    """Rolling latency, error and concurrency telemetry for one model"""
+    
+    def __init__(self, window_seconds: float, max_samples: int = 200):
+        self.window_seconds = window_seconds
+        # (monotonic time, value) of recent requests, so an outage stops counting once it is over
+        self.latencies_ms: Deque[Tuple[float, int]] = deque(maxlen=max_samples)
+        self.outcomes: Deque[Tuple[float, bool]] = deque(maxlen=max_samples)
+        self.in_flight = 0
+    
+    def _prune(self) -> None:
+        """Forget requests older than the window"""
+        cutoff = time.monotonic() - self.window_seconds
+        for samples in (self.latencies_ms, self.outcomes):
+            while samples and samples[0][0] < cutoff:
+                samples.popleft()
+    
+    @property
+    def samples(self) -> int:
+        self._prune()
+        return len(self.outcomes)
+    
+    @property
+    def error_rate(self) -> float:
+        self._prune()
+        if not self.outcomes:
+            return 0.0
+        return sum(1 for _, ok in self.outcomes if not ok) / len(self.outcomes)
+    
+    def percentile(self, fraction: float) -> Optional[float]:
+        """Latency percentile over successful requests, None without data"""
+        self._prune()
+        if not self.latencies_ms:
+            return None
+        ordered = sorted(latency for _, latency in self.latencies_ms)
+        return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+    
+    def record(self, ok: bool, latency_ms: int) -> None:
+        now = time.monotonic()
+        self.outcomes.append((now, ok))
+        if ok:
+            self.latencies_ms.append((now, latency_ms))
+
 class OpenRouterClient:
     def __init__(self):
         self.api_key = Config.OPENROUTER_API_KEY
@@ -14,36 +131,147 @@ class OpenRouterClient:
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.cache_stats: Dict[str, Dict[str, int]] = {}
+        self.model_stats: Dict[str, ModelStats] = {}
+    
+    async def start(self) -> None:
+        """Create the shared HTTP session"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(headers=self.headers)
+    
+    async def close(self) -> None:
+        """Close the shared HTTP session"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
     
-    async def get_completion(self, messages: List[Dict[str, Any]], model: str, plugins: List[Dict[str, Any]] = None) -> str:
-        """Get completion from OpenRouter API"""
+    @staticmethod
+    def _uses_explicit_caching(model: str) -> bool:
+        """Anthropic models only cache prefixes marked with cache_control"""
+        return model.startswith("anthropic/")
+    
+    @staticmethod
+    def _mark_cache_breakpoint(message: Dict[str, Any]) -> Dict[str, Any]:
+        """Return a copy of a message with a cache breakpoint on its last text part"""
+        content = message["content"]
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        
+        for index in range(len(content) - 1, -1, -1):
+            if content[index].get("type") == "text":
+                content = list(content)
+                content[index] = {**content[index], "cache_control": {"type": "ephemeral"}}
+                return {**message, "content": content}
+        return message
+    
+    def _with_cache_breakpoints(self, messages: List[Dict[str, Any]], model: str) -> List[Dict[str, Any]]:
+        """Mark the system prompt and the end of the replayed history as cacheable.
+        
+        Other providers cache stable prefixes implicitly, so messages are left as is.
+        """
+        if not self._uses_explicit_caching(model) or len(messages) < 2:
+            return messages
+        
+        messages = list(messages)
+        if messages[0]["role"] == "system":
+            messages[0] = self._mark_cache_breakpoint(messages[0])
+        
+        # Everything before the new user message is repeated verbatim next turn
+        last_stable = len(messages) - 2
+        if last_stable > 0:
+            messages[last_stable] = self._mark_cache_breakpoint(messages[last_stable])
+        return messages
+    
+    def _record_usage(self, result: CompletionResult) -> None:
+        """Accumulate prompt and cached token counts per model"""
+        stats = self.cache_stats.setdefault(result.model, {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0})
+        stats["requests"] += 1
+        stats["prompt_tokens"] += result.prompt_tokens
+        stats["cached_tokens"] += result.cached_tokens
+        logger.debug(f"{result.model}: {result.cached_tokens}/{result.prompt_tokens} prompt tokens served from cache")
+    
+    def stats_for(self, model: str) -> ModelStats:
+        """Telemetry for a model, created on first use"""
+        if model not in self.model_stats:
+            self.model_stats[model] = ModelStats(Config.ROUTING_STATS_WINDOW_SECONDS)
+        return self.model_stats[model]
+    
+    async def complete(self, messages: List[Dict[str, Any]], model: str, plugins: List[Dict[str, Any]] = None) -> CompletionResult:
+        """Get completion from OpenRouter API, raising OpenRouterError on failure"""
+        await self.start()
+        payload = {
+            "model": model,
+            "messages": self._with_cache_breakpoints(messages, model),
+            "usage": {"include": True}
+        }
+        
+        # Add plugins if provided (for online models)
+        if plugins:
+            payload["plugins"] = plugins
+        
+        stats = self.stats_for(model)
+        stats.in_flight += 1
+        started = time.monotonic()
         try:
-            async with aiohttp.ClientSession() as session:
-                payload = {
-                    "model": model,
-                    "messages": messages
-                }
+            # Attachments are base64-encoded straight into the socket instead of
+            # being serialized into one large JSON string first
+            if contains_attachment(messages):
+                body = {"data": stream_json(payload)}
+            else:
+                body = {"json": payload}
+            
+            async with self._session.post(
+                f"{self.base_url}/chat/completions",
+                **body
+            ) as response:
+                if response.status != 200:
+                    error_text = await response.text()
+                    raise OpenRouterError(f"OpenRouter API error: {response.status} - {error_text}")
                 
-                # Add plugins if provided (for online models)
-                if plugins:
-                    payload["plugins"] = plugins
-                
-                async with session.post(
-                    f"{self.base_url}/chat/completions",
-                    json=payload,
-                    headers=self.headers
-                ) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        return data["choices"][0]["message"]["content"]
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"OpenRouter API error: {response.status} - {error_text}")
-                        return "Sorry, I couldn't get a response from the AI service."
+                data = await response.json()
+        except asyncio.CancelledError:
+            # A cancelled request says nothing about the model's health
+            raise
+        except Exception:
+            stats.record(False, int((time.monotonic() - started) * 1000))
+            raise
+        finally:
+            stats.in_flight -= 1
         
+        usage = data.get("usage") or {}
+        result = CompletionResult(
+            content=data["choices"][0]["message"]["content"],
+            model=data.get("model") or model,
+            generation_id=data.get("id"),
+            prompt_tokens=usage.get("prompt_tokens") or 0,
+            completion_tokens=usage.get("completion_tokens") or 0,
+            cached_tokens=(usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0,
+            cost=usage.get("cost") or 0.0,
+            latency_ms=int((time.monotonic() - started) * 1000)
+        )
+        stats.record(True, result.latency_ms)
+        self._record_usage(result)
+        return result
+    
+    async def get_completion(self, messages: List[Dict[str, Any]], model: str, plugins: List[Dict[str, Any]] = None) -> CompletionResult:
+        """Get completion from OpenRouter API, with a fallback message on failure"""
+        started = time.monotonic()
+        try:
+            return await self.complete(messages, model, plugins)
+        except OpenRouterError as e:
+            logger.error(str(e))
+            content = "Sorry, I couldn't get a response from the AI service."
         except Exception as e:
             logger.error(f"Error calling OpenRouter API: {e}")
-            return "Sorry, I encountered an error while processing your request."
+            content = "Sorry, I encountered an error while processing your request."
+        
+        return CompletionResult(
+            content=content,
+            model=model,
+            ok=False,
+            latency_ms=int((time.monotonic() - started) * 1000)
+        )
 
 # Global OpenRouter client instance
 openrouter_client = OpenRouterClient()
\ No newline at end of file
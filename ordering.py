@@ -0,0 +1,67 @@
+import asyncio
+import sys
+from typing import Any, Awaitable, Dict, Optional
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+class UserLock:
+    """Lock of one user and the number of updates holding or waiting for it"""
+    
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently, but one user's updates one at a time.
+    
+    Updates from different users run in parallel up to max_concurrent_updates,
+    while updates from the same user (or the same chat, for updates without a
+    user) wait for each other and run in the order they arrived. An update
+    only takes a concurrency slot once it is its user's turn, so one user
+    flooding the bot cannot hold the slots other users need. Handlers that
+    start long work, like model requests, hand it off to a task so the user's
+    next update, such as /cancel, is not held behind it.
+    """
+    
+    def __init__(self, max_concurrent_updates: int):
+        # The base class takes its slot before an update waits for its user, so
+        # it is left unbounded and the limit is applied after the user lock
+        super().__init__(sys.maxsize)
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._locks: Dict[int, UserLock] = {}
+    
+    @staticmethod
+    def _key(update: object) -> Optional[int]:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return None
+    
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self._key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+        
+        # asyncio.Lock wakes waiters first in, first out, which keeps arrival order
+        user_lock = self._locks.get(key)
+        if user_lock is None:
+            user_lock = self._locks[key] = UserLock()
+        user_lock.users += 1
+        try:
+            async with user_lock.lock, self._slots:
+                await coroutine
+        finally:
+            user_lock.users -= 1
+            if not user_lock.users:
+                del self._locks[key]
+    
+    async def initialize(self) -> None:
+        pass
+    
+    async def shutdown(self) -> None:
+        pass
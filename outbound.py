@@ -0,0 +1,135 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from asyncio_throttle import Throttler
+from telegram import CallbackQuery, Message
+from telegram.error import BadRequest, RetryAfter
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Longest text Telegram accepts in one message
+MAX_MESSAGE_LENGTH = 4096
+
+def split_text(text: str, limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """Split text into message-sized parts, preferring line and word boundaries"""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = text.rfind(" ", 0, limit)
+        if cut <= 0:
+            parts.append(text[:limit])
+            text = text[limit:]
+            continue
+        parts.append(text[:cut])
+        text = text[cut + 1:]
+    parts.append(text)
+    return parts
+
+class ChatChannel:
+    """Send order and rate limit of one chat"""
+    
+    def __init__(self, chat_id: int):
+        self.lock = asyncio.Lock()
+        # Telegram allows about one message per second in a chat and 20 per minute in a group
+        if chat_id < 0:
+            self.throttler = Throttler(Config.OUTBOUND_GROUP_CHAT_RATE_PER_MINUTE, period=60.0)
+        else:
+            self.throttler = Throttler(Config.OUTBOUND_PRIVATE_CHAT_RATE, period=1.0)
+
+class OutboundSender:
+    """Sends replies and edits within Telegram's flood limits.
+    
+    Every request passes a global token bucket and the bucket of its chat, and
+    requests to one chat go out in the order they were made. RetryAfter errors
+    are waited out and the request is retried, long texts are split into
+    several messages, and an edit that is superseded while it waits is
+    dropped in favour of the newest one.
+    """
+    
+    def __init__(self, global_rate: int, max_chats: int = 10000):
+        self._global = Throttler(global_rate, period=1.0)
+        self._chats: "OrderedDict[int, ChatChannel]" = OrderedDict()
+        self._max_chats = max_chats
+        self._pending_edits: Dict[Tuple[int, int], Dict[str, Any]] = {}
+    
+    def _channel(self, chat_id: int) -> ChatChannel:
+        """Channel of a chat, forgetting the least recently used idle ones"""
+        channel = self._chats.get(chat_id)
+        if channel is None:
+            channel = self._chats[chat_id] = ChatChannel(chat_id)
+        self._chats.move_to_end(chat_id)
+        
+        while len(self._chats) > self._max_chats:
+            oldest_id, oldest = next(iter(self._chats.items()))
+            if oldest.lock.locked():
+                break
+            del self._chats[oldest_id]
+        return channel
+    
+    async def _send(self, chat_id: int, request: Callable[[], Awaitable[Any]]) -> Any:
+        """Run a request within the rate limits, retrying after flood control"""
+        attempt = 0
+        while True:
+            async with self._channel(chat_id).throttler, self._global:
+                try:
+                    return await request()
+                except RetryAfter as e:
+                    attempt += 1
+                    if attempt > Config.OUTBOUND_MAX_RETRIES:
+                        raise
+                    delay = e.retry_after
+                    logger.warning(f"Flood control in chat {chat_id}, retrying in {delay}s")
+            await asyncio.sleep(delay)
+    
+    async def reply_text(self, message: Message, text: str, **kwargs: Any) -> Optional[Message]:
+        """Reply to a message, in several parts if the text is too long"""
+        parts = split_text(text)
+        reply_markup = kwargs.pop("reply_markup", None)
+        channel = self._channel(message.chat_id)
+        
+        sent = None
+        async with channel.lock:
+            for index, part in enumerate(parts):
+                # Keyboards belong under the last part
+                markup = reply_markup if index == len(parts) - 1 else None
+                sent = await self._send(
+                    message.chat_id,
+                    lambda part=part, markup=markup: message.reply_text(part, reply_markup=markup, **kwargs)
+                )
+        return sent
+    
+    async def edit_message_text(self, query: CallbackQuery, text: str, **kwargs: Any) -> None:
+        """Edit the message of a callback query, coalescing edits that pile up"""
+        chat_id = query.message.chat_id
+        key = (chat_id, query.message.message_id)
+        
+        pending = self._pending_edits.get(key)
+        if pending is not None:
+            # An earlier edit of this message is still waiting; it will send this text instead
+            pending.update(text=text, kwargs=kwargs)
+            return
+        
+        edit = {"text": text, "kwargs": kwargs}
+        self._pending_edits[key] = edit
+        
+        async def request() -> Any:
+            # From here on, newer edits queue up as a separate request
+            if self._pending_edits.get(key) is edit:
+                del self._pending_edits[key]
+            return await query.edit_message_text(edit["text"], **edit["kwargs"])
+        
+        try:
+            async with self._channel(chat_id).lock:
+                await self._send(chat_id, request)
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
+        finally:
+            if self._pending_edits.get(key) is edit:
+                del self._pending_edits[key]
+
+# Global outbound sender instance; with several shards each one gets a share of the global limit
+outbound = OutboundSender(max(1, Config.OUTBOUND_GLOBAL_RATE // max(Config.SHARD_WORKERS, 1)))
@@ -0,0 +1,63 @@
+import logging
+from typing import List, Dict, Any
+from config import Config
+from openrouter import openrouter_client
+
+logger = logging.getLogger(__name__)
+
+class ModelRouter:
+    """Picks a model for "auto" users from live OpenRouter telemetry.
+    
+    Light requests go to the model with the lowest median latency, heavy
+    ones (attachments or long prompts) to the one with the lowest p95, and
+    each estimate is scaled by the model's current number of in-flight
+    requests. Models with too many recent errors are avoided while a
+    healthy alternative exists, and models without enough samples are
+    tried first so every model keeps producing telemetry. Telemetry only
+    covers the last ROUTING_STATS_WINDOW_SECONDS, so once an avoided model's
+    errors age out it is tried again.
+    """
+    
+    @staticmethod
+    def request_size(messages: List[Dict[str, Any]]) -> int:
+        """Characters of text in a request"""
+        size = 0
+        for message in messages:
+            content = message["content"]
+            if isinstance(content, str):
+                size += len(content)
+                continue
+            for part in content:
+                if part.get("type") == "text":
+                    size += len(part["text"])
+        return size
+    
+    def score(self, model: str, heavy: bool) -> float:
+        """Expected latency of a new request on a model, lower is better"""
+        stats = openrouter_client.stats_for(model)
+        if stats.samples < Config.ROUTING_MIN_SAMPLES:
+            return float(stats.in_flight)
+        
+        latency = stats.percentile(0.95 if heavy else 0.5)
+        if latency is None:
+            return float("inf")
+        return latency * (1 + stats.in_flight)
+    
+    def choose(self, models: List[str], messages: List[Dict[str, Any]], has_attachments: bool) -> str:
+        """Choose the model to serve a request from the tier's models"""
+        candidates = [model for model in models if model != Config.AUTO_MODEL]
+        heavy = has_attachments or self.request_size(messages) > Config.ROUTING_HEAVY_REQUEST_CHARS
+        
+        healthy = [
+            model for model in candidates
+            if openrouter_client.stats_for(model).error_rate < Config.ROUTING_MAX_ERROR_RATE
+        ]
+        if not healthy:
+            healthy = sorted(candidates, key=lambda model: openrouter_client.stats_for(model).error_rate)[:1]
+        
+        model = min(healthy, key=lambda model: self.score(model, heavy))
+        logger.debug(f"Routing {'heavy' if heavy else 'light'} request to {model}")
+        return model
+
+# Global model router instance
+model_router = ModelRouter()
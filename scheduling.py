@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Deque, Dict, Optional, Tuple
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+class OverloadedError(Exception):
+    """Raised when a request is shed instead of queued for a model slot"""
+
+class TierStats:
+    """Rolling queue wait telemetry for one tier"""
+    
+    def __init__(self, window_seconds: float, max_samples: int = 500):
+        self.window_seconds = window_seconds
+        # (monotonic time, wait in ms) of the most recent requests
+        self.waits_ms: Deque[Tuple[float, int]] = deque(maxlen=max_samples)
+        self.served = 0
+        self.shed = 0
+    
+    def _prune(self) -> None:
+        """Forget waits older than the window, so old bursts stop counting"""
+        cutoff = time.monotonic() - self.window_seconds
+        while self.waits_ms and self.waits_ms[0][0] < cutoff:
+            self.waits_ms.popleft()
+    
+    def percentile(self, fraction: float) -> Optional[float]:
+        """Wait percentile over the window, None without data"""
+        self._prune()
+        if not self.waits_ms:
+            return None
+        ordered = sorted(wait for _, wait in self.waits_ms)
+        return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+    
+    def record(self, wait_ms: int) -> None:
+        self.waits_ms.append((time.monotonic(), wait_ms))
+        self.served += 1
+
+class FairScheduler:
+    """Weighted fair queue in front of model requests.
+    
+    At most `concurrency` requests run at once. Waiting requests are queued per
+    tier, and each free slot goes to the tier with the lowest virtual time,
+    which advances by 1/weight per request served, so tiers share capacity in
+    proportion to their weights. A request is shed when its tier's queue is
+    full, and sheddable tiers are also shed while another tier has requests
+    queued and its p95 wait over the last SCHEDULER_WAIT_WINDOW_SECONDS is over
+    SCHEDULER_WAIT_SLO_MS.
+    """
+    
+    def __init__(self, concurrency: int, tiers: Dict[str, Dict[str, Any]]):
+        self.concurrency = concurrency
+        self.tiers = tiers
+        self.active = 0
+        self.stats = {tier: TierStats(Config.SCHEDULER_WAIT_WINDOW_SECONDS) for tier in tiers}
+        self._waiting: Dict[str, Deque[asyncio.Future]] = {tier: deque() for tier in tiers}
+        self._virtual = {tier: 0.0 for tier in tiers}
+        self._clock = 0.0
+    
+    def _queued(self) -> int:
+        return sum(len(waiting) for waiting in self._waiting.values())
+    
+    def _should_shed(self, tier: str) -> bool:
+        """Decide whether a request that would have to wait is rejected instead"""
+        settings = self.tiers[tier]
+        if len(self._waiting[tier]) >= settings["max_queue"]:
+            return True
+        if not settings["sheddable"]:
+            return False
+        
+        # Only protect tiers that are waiting right now, by their recent waits
+        for other, other_settings in self.tiers.items():
+            if other_settings["sheddable"] or not self._waiting[other]:
+                continue
+            wait = self.stats[other].percentile(0.95)
+            if wait is not None and wait > Config.SCHEDULER_WAIT_SLO_MS:
+                return True
+        return False
+    
+    def _grant(self) -> None:
+        """Hand free slots to waiting requests in weighted fair order"""
+        while self.active < self.concurrency:
+            candidates = [tier for tier, waiting in self._waiting.items() if waiting]
+            if not candidates:
+                return
+            
+            tier = min(candidates, key=lambda tier: self._virtual[tier])
+            future = self._waiting[tier].popleft()
+            if future.done():
+                continue
+            
+            self._clock = self._virtual[tier]
+            self._virtual[tier] += 1 / self.tiers[tier]["weight"]
+            self.active += 1
+            future.set_result(None)
+    
+    async def acquire(self, tier: str) -> None:
+        """Wait for a model slot, raising OverloadedError if the request is shed"""
+        if tier not in self.tiers:
+            tier = "lite"
+        started = time.monotonic()
+        
+        if self.active < self.concurrency and not self._queued():
+            self._clock = max(self._virtual[tier], self._clock)
+            self._virtual[tier] = self._clock + 1 / self.tiers[tier]["weight"]
+            self.active += 1
+            self.stats[tier].record(0)
+            return
+        
+        if self._should_shed(tier):
+            self.stats[tier].shed += 1
+            raise OverloadedError(f"Shed {tier} request with {self._queued()} requests queued")
+        
+        # A tier that was idle joins at the current virtual time instead of using up banked credit
+        if not self._waiting[tier]:
+            self._virtual[tier] = max(self._virtual[tier], self._clock)
+        
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[tier].append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                if future in self._waiting[tier]:
+                    self._waiting[tier].remove(future)
+            else:
+                # The slot was granted just before the cancellation
+                self.release()
+            raise
+        
+        self.stats[tier].record(int((time.monotonic() - started) * 1000))
+    
+    def release(self) -> None:
+        """Return a slot and pass it on"""
+        self.active -= 1
+        self._grant()
+    
+    @asynccontextmanager
+    async def slot(self, tier: str) -> AsyncIterator[None]:
+        """Hold a model slot for the duration of a request"""
+        await self.acquire(tier)
+        try:
+            yield
+        finally:
+            self.release()
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """Queue depth, throughput and wait percentiles per tier"""
+        return {
+            "active": self.active,
+            "tiers": {
+                tier: {
+                    "queued": len(self._waiting[tier]),
+                    "served": stats.served,
+                    "shed": stats.shed,
+                    "wait_p50_ms": stats.percentile(0.5),
+                    "wait_p95_ms": stats.percentile(0.95)
+                }
+                for tier, stats in self.stats.items()
+            }
+        }
+
+# Global model request scheduler instance
+model_scheduler = FairScheduler(Config.MODEL_CONCURRENCY, Config.SCHEDULER_TIERS)
@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import re
+from pathlib import Path
+from typing import List, Tuple, Set
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = Path(__file__).resolve().parent / "migrations"
+
+# Arbitrary key shared by every instance so only one applies migrations at a time
+MIGRATION_LOCK_ID = 7_421_003
+
+class MigrationRunner:
+    def __init__(self, migrations_dir: Path = MIGRATIONS_DIR):
+        self.migrations_dir = migrations_dir
+    
+    def discover(self) -> List[Tuple[int, str, Path]]:
+        """List migration files as (version, name, path), ordered by version"""
+        migrations = []
+        for path in self.migrations_dir.glob("*.sql"):
+            match = re.match(r"^(\d+)_(\w+)\.sql$", path.name)
+            if not match:
+                logger.warning(f"Skipping unrecognized migration file: {path.name}")
+                continue
+            migrations.append((int(match.group(1)), match.group(2), path))
+        return sorted(migrations)
+    
+    async def run(self, supabase) -> bool:
+        """Apply pending migrations if DATABASE_URL is set, then verify the applied state"""
+        if Config.DATABASE_URL:
+            try:
+                await self.apply_pending()
+            except Exception as e:
+                logger.error(f"Error applying migrations: {e}")
+        
+        return await asyncio.to_thread(self.verify, supabase)
+    
+    async def apply_pending(self) -> None:
+        """Apply every migration that is not yet recorded, each in its own transaction"""
+        import asyncpg
+        
+        conn = await asyncpg.connect(Config.DATABASE_URL)
+        try:
+            await conn.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK_ID)
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS public.schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    name VARCHAR(255) NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            
+            applied = {row['version'] for row in await conn.fetch("SELECT version FROM public.schema_migrations")}
+            pending = [m for m in self.discover() if m[0] not in applied]
+            
+            for version, name, path in pending:
+                logger.info(f"Applying migration {version:04d}_{name}")
+                async with conn.transaction():
+                    await conn.execute(path.read_text())
+                    await conn.execute(
+                        "INSERT INTO public.schema_migrations (version, name) VALUES ($1, $2) ON CONFLICT (version) DO NOTHING",
+                        version, name
+                    )
+            
+            if pending:
+                # Make new tables and functions visible to PostgREST
+                await conn.execute("NOTIFY pgrst, 'reload schema'")
+        finally:
+            await conn.close()
+    
+    def verify(self, supabase) -> bool:
+        """Check that every migration on disk is recorded as applied"""
+        try:
+            response = supabase.table('schema_migrations').select('version').execute()
+            applied: Set[int] = {row['version'] for row in response.data}
+        except Exception as e:
+            logger.error(f"Database schema not found. Set DATABASE_URL or run the files in migrations/ in your Supabase dashboard: {e}")
+            logger.error("Go to Supabase Dashboard → SQL Editor → Run migrations/*.sql in order")
+            return False
+        
+        known = {version for version, _, _ in self.discover()}
+        pending = sorted(known - applied)
+        unknown = sorted(applied - known)
+        
+        if unknown:
+            logger.warning(f"Database has migrations this build doesn't know about: {unknown}")
+        if pending:
+            logger.error(f"Pending database migrations: {pending}. Set DATABASE_URL or run them in the Supabase SQL Editor")
+            return False
+        
+        logger.info(f"Database schema verified at version {max(known, default=0)}")
+        return True
+
+# Global migration runner instance
+migration_runner = MigrationRunner()
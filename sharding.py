@@ -0,0 +1,309 @@
+import asyncio
+import logging
+import multiprocessing
+import queue
+import signal
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+from aiohttp import web
+from telegram import Bot, Update
+from config import Config
+from bot import TelegramBot, install_stop_handlers
+from database import db
+
+logger = logging.getLogger(__name__)
+
+# How often workers report liveness and the front process checks it
+HEARTBEAT_INTERVAL_SECONDS = 1
+HEALTH_CHECK_INTERVAL_SECONDS = 5
+
+def shard_key(data: Dict[str, Any]) -> int:
+    """User an update belongs to, falling back to its chat or the update itself"""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        user = value.get("from") or value.get("user")
+        if isinstance(user, dict) and "id" in user:
+            return user["id"]
+        chat = value.get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return chat["id"]
+    return data.get("update_id", 0)
+
+def run_worker(shard: int, updates: multiprocessing.Queue, heartbeat, taken) -> None:
+    """Entry point of a worker process"""
+    # The front process owns shutdown and tells workers to drain
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_serve_worker(shard, updates, heartbeat, taken))
+
+async def _beat(heartbeat) -> None:
+    """Report that the worker's event loop is responsive"""
+    while True:
+        heartbeat.value = time.time()
+        await asyncio.sleep(HEARTBEAT_INTERVAL_SECONDS)
+
+async def _serve_worker(shard: int, updates: multiprocessing.Queue, heartbeat, taken) -> None:
+    """Feed updates from the shard queue to a bot until the drain signal arrives"""
+    # Each shard keeps its own usage journal so restarts recover only their own batches
+    db.usage.journal_dir = db.usage.journal_dir / f"shard-{shard}"
+    
+    # Only one shard runs the maintenance jobs
+    bot = TelegramBot(polling=False, maintenance=shard == 0, shard=shard)
+    beat = asyncio.create_task(_beat(heartbeat))
+    loop = asyncio.get_running_loop()
+    
+    await bot.start_worker()
+    logger.info(f"Shard {shard} started")
+    try:
+        while True:
+            try:
+                item = await loop.run_in_executor(None, updates.get, True, HEARTBEAT_INTERVAL_SECONDS)
+            except queue.Empty:
+                continue
+            if item is None:
+                break
+            sequence, data = item
+            # The bot runs each user's handlers one at a time in the order they are queued here
+            await bot.application.update_queue.put(Update.de_json(data, bot.application.bot))
+            # Tell the front process it no longer has to queue this update again
+            taken.value = sequence
+    finally:
+        logger.info(f"Shard {shard} draining")
+        await bot.stop_worker()
+        beat.cancel()
+
+class ShardSupervisor:
+    """Front process that receives updates and shards them by user across worker processes.
+    
+    Updates arrive by webhook when WEBHOOK_URL is set, otherwise by polling, and
+    go to worker user_id % SHARD_WORKERS so that one user's updates are always
+    handled by the same worker, which runs them one at a time in arrival order.
+    Each worker runs its own TelegramBot with its own database, HTTP clients
+    and caches. Workers that exit or stop sending heartbeats are restarted, and
+    the updates they had not taken from their queue yet are queued again for
+    the replacement. On shutdown each worker finishes its queue and running
+    requests before the front process exits.
+    """
+    
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._context = multiprocessing.get_context("spawn")
+        self._queues = [self._context.Queue(Config.SHARD_QUEUE_SIZE) for _ in range(workers)]
+        self._heartbeats = [self._context.Value("d", 0.0) for _ in range(workers)]
+        # Sequence number of the last update each worker took; it has a single writer,
+        # and no lock that a worker killed mid-write could leave held
+        self._taken = [self._context.Value("q", 0, lock=False) for _ in range(workers)]
+        self._sequences = [0] * workers
+        self._pending: List[Deque[Tuple[int, Dict[str, Any]]]] = [deque() for _ in range(workers)]
+        self._processes: List[Optional[multiprocessing.process.BaseProcess]] = [None] * workers
+        self._bot = Bot(Config.TELEGRAM_BOT_TOKEN)
+        self._offset: Optional[int] = None
+        self._stopping = False
+    
+    def _start_worker(self, shard: int) -> None:
+        """Start the worker process for a shard"""
+        # Give the new process the full timeout to come up
+        self._heartbeats[shard].value = time.time()
+        process = self._context.Process(
+            target=run_worker,
+            args=(shard, self._queues[shard], self._heartbeats[shard], self._taken[shard]),
+            name=f"shard-{shard}"
+        )
+        process.start()
+        self._processes[shard] = process
+        logger.info(f"Started shard {shard} as process {process.pid}")
+    
+    def _queue_depth(self, shard: int) -> Optional[int]:
+        try:
+            return self._queues[shard].qsize()
+        except NotImplementedError:
+            return None
+    
+    def health(self) -> List[Dict[str, Any]]:
+        """Liveness, heartbeat age and backlog of every shard"""
+        now = time.time()
+        status = []
+        for shard, process in enumerate(self._processes):
+            age = now - self._heartbeats[shard].value
+            alive = process is not None and process.is_alive()
+            status.append({
+                "shard": shard,
+                "alive": alive,
+                "healthy": alive and age < Config.SHARD_HEARTBEAT_TIMEOUT_SECONDS,
+                "heartbeat_age": round(age, 1),
+                "queued": self._queue_depth(shard)
+            })
+        return status
+    
+    async def _monitor(self) -> None:
+        """Restart workers that exited or stopped responding"""
+        while not self._stopping:
+            await asyncio.sleep(HEALTH_CHECK_INTERVAL_SECONDS)
+            for entry in self.health():
+                if entry["healthy"] or self._stopping:
+                    continue
+                
+                shard = entry["shard"]
+                process = self._processes[shard]
+                if entry["alive"]:
+                    logger.error(f"Shard {shard} missed heartbeats for {entry['heartbeat_age']}s, restarting")
+                    process.kill()
+                else:
+                    logger.error(f"Shard {shard} exited with code {process.exitcode}, restarting")
+                await asyncio.to_thread(process.join)
+                
+                # A worker killed inside get() keeps the queue's reader lock forever, so the
+                # replacement reads from a new queue, starting with what the old one still held
+                old_queue = self._queues[shard]
+                self._queues[shard] = self._context.Queue(Config.SHARD_QUEUE_SIZE)
+                old_queue.close()
+                old_queue.cancel_join_thread()
+                self._requeue(shard)
+                self._start_worker(shard)
+    
+    def _untaken(self, shard: int) -> Deque[Tuple[int, Dict[str, Any]]]:
+        """Updates queued on a shard that its worker has not taken yet"""
+        pending = self._pending[shard]
+        taken = self._taken[shard].value
+        while pending and pending[0][0] <= taken:
+            pending.popleft()
+        return pending
+    
+    def _requeue(self, shard: int) -> None:
+        """Put the updates a dead worker never took on its shard's new queue"""
+        pending = self._untaken(shard)
+        if pending:
+            logger.warning(f"Requeueing {len(pending)} updates for shard {shard}")
+        
+        requeued: Deque[Tuple[int, Dict[str, Any]]] = deque()
+        for sequence, data in pending:
+            try:
+                self._queues[shard].put_nowait((sequence, data))
+                requeued.append((sequence, data))
+            except queue.Full:
+                logger.error(f"Shard {shard} queue is full, dropping update {data.get('update_id')}")
+        self._pending[shard] = requeued
+    
+    def dispatch(self, data: Dict[str, Any]) -> bool:
+        """Queue an update on its shard, returning False when the shard is backed up"""
+        shard = shard_key(data) % self.workers
+        sequence = self._sequences[shard] + 1
+        try:
+            self._queues[shard].put_nowait((sequence, data))
+        except queue.Full:
+            logger.warning(f"Shard {shard} queue is full, deferring update {data.get('update_id')}")
+            return False
+        
+        # Kept until the worker takes it, so a restarted worker gets it again
+        self._sequences[shard] = sequence
+        self._untaken(shard).append((sequence, data))
+        return True
+    
+    async def handle_webhook(self, request: web.Request) -> web.Response:
+        """Accept an update from Telegram; errors make Telegram retry it later"""
+        if self._stopping:
+            return web.Response(status=503)
+        if (Config.WEBHOOK_SECRET_TOKEN and
+                request.headers.get("X-Telegram-Bot-Api-Secret-Token") != Config.WEBHOOK_SECRET_TOKEN):
+            return web.Response(status=403)
+        
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        return web.Response(status=200 if self.dispatch(data) else 503)
+    
+    async def handle_health(self, request: web.Request) -> web.Response:
+        """Report shard health for load balancers and container checks"""
+        status = self.health()
+        healthy = not self._stopping and all(entry["healthy"] for entry in status)
+        return web.json_response({"shards": status}, status=200 if healthy else 503)
+    
+    async def _poll(self) -> None:
+        """Fetch updates by long polling, for running without a public URL"""
+        await self._bot.delete_webhook()
+        while True:
+            try:
+                updates = await self._bot.get_updates(
+                    offset=self._offset, timeout=10, allowed_updates=Update.ALL_TYPES
+                )
+            except Exception as e:
+                logger.error(f"Error fetching updates: {e}")
+                await asyncio.sleep(1)
+                continue
+            
+            for update in updates:
+                data = update.to_dict()
+                while not self.dispatch(data):
+                    await asyncio.sleep(0.5)
+                self._offset = update.update_id + 1
+    
+    async def _serve(self) -> None:
+        for shard in range(self.workers):
+            self._start_worker(shard)
+        
+        stop = asyncio.Event()
+        install_stop_handlers(stop)
+        
+        app = web.Application()
+        app.router.add_get("/healthz", self.handle_health)
+        if Config.WEBHOOK_URL:
+            app.router.add_post(urlparse(Config.WEBHOOK_URL).path or "/", self.handle_webhook)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "0.0.0.0", Config.WEBHOOK_PORT).start()
+        
+        async with self._bot:
+            if Config.WEBHOOK_URL:
+                await self._bot.set_webhook(
+                    Config.WEBHOOK_URL,
+                    secret_token=Config.WEBHOOK_SECRET_TOKEN or None,
+                    allowed_updates=Update.ALL_TYPES
+                )
+                receiver = None
+                logger.info(f"Receiving updates on port {Config.WEBHOOK_PORT} for {self.workers} shards")
+            else:
+                receiver = asyncio.create_task(self._poll())
+                logger.info(f"Polling for updates for {self.workers} shards")
+            monitor = asyncio.create_task(self._monitor())
+            
+            await stop.wait()
+            logger.info("Stopping, draining shards...")
+            self._stopping = True
+            for task in (receiver, monitor):
+                if task is not None:
+                    task.cancel()
+            await asyncio.gather(*(task for task in (receiver, monitor) if task is not None), return_exceptions=True)
+            
+            # Confirm polled updates so they are not delivered again after a restart
+            if receiver is not None and self._offset is not None:
+                try:
+                    await self._bot.get_updates(offset=self._offset, timeout=0, limit=1)
+                except Exception as e:
+                    logger.error(f"Error confirming updates: {e}")
+        
+        await runner.cleanup()
+        await asyncio.to_thread(self._drain)
+    
+    def _drain(self) -> None:
+        """Let every worker finish its queue, terminating those that overrun the deadline"""
+        deadline = time.monotonic() + Config.SHARD_DRAIN_SECONDS
+        for shard, shard_queue in enumerate(self._queues):
+            try:
+                shard_queue.put(None, timeout=max(deadline - time.monotonic(), 0.1))
+            except queue.Full:
+                logger.error(f"Shard {shard} queue is still full, it will be terminated")
+        
+        for shard, process in enumerate(self._processes):
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.warning(f"Shard {shard} did not drain in time, terminating")
+                process.terminate()
+                process.join()
+        logger.info("All shards stopped")
+    
+    def run(self) -> None:
+        """Run the front process until SIGINT or SIGTERM"""
+        asyncio.run(self._serve())
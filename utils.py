@@ -1,33 +1,96 @@
 import io
 import base64
 import logging
-from typing import Optional, List, Dict, Any
-from PIL import Image
-import PyPDF2
+from typing import Optional, List, Dict, Any, Iterator
 import aiohttp
+from config import Config
 
 logger = logging.getLogger(__name__)
 
+# Raw bytes per base64 chunk; a multiple of 3 so chunks concatenate without padding
+BASE64_CHUNK_SIZE = 3 * 16 * 1024
+
+class Attachment:
+    """Binary attachment sent to the API as a base64 data URL.
+    
+    The bytes are kept as they are and only encoded chunk by chunk while the
+    request body is written, so no full base64 copy exists during a request.
+    """
+    
+    def __init__(self, data: bytes, mime_type: str):
+        self.data = memoryview(data)
+        self.mime_type = mime_type
+    
+    @property
+    def prefix(self) -> bytes:
+        return f"data:{self.mime_type};base64,".encode("ascii")
+    
+    def iter_data_url(self) -> Iterator[bytes]:
+        """Yield the data URL in chunks"""
+        yield self.prefix
+        for offset in range(0, len(self.data), BASE64_CHUNK_SIZE):
+            yield base64.b64encode(self.data[offset:offset + BASE64_CHUNK_SIZE])
+    
+    def to_data_url(self) -> str:
+        """Build the whole data URL, for storage outside of a request"""
+        return b"".join(self.iter_data_url()).decode("ascii")
+    
+    @staticmethod
+    def materialize(content: Any) -> Any:
+        """Replace attachments in message content with data URL strings"""
+        if isinstance(content, Attachment):
+            return content.to_data_url()
+        if isinstance(content, dict):
+            return {key: Attachment.materialize(value) for key, value in content.items()}
+        if isinstance(content, list):
+            return [Attachment.materialize(value) for value in content]
+        return content
+
+class FileTooLargeError(Exception):
+    """Raised when a download exceeds its size limit"""
+
 class FileProcessor:
     @staticmethod
-    async def download_file(file_url: str) -> Optional[bytes]:
-        """Download file from Telegram servers"""
+    async def download_file(file_url: str, max_bytes: Optional[int] = None) -> Optional[bytes]:
+        """Download file from Telegram servers, aborting once it exceeds max_bytes"""
         try:
             async with aiohttp.ClientSession() as session:
                 async with session.get(file_url) as response:
                     if response.status == 200:
-                        return await response.read()
+                        if max_bytes is not None and response.content_length and response.content_length > max_bytes:
+                            raise FileTooLargeError(f"File is {response.content_length} bytes, limit is {max_bytes}")
+                        
+                        # BytesIO hands its buffer to getvalue() without another copy
+                        buffer = io.BytesIO()
+                        async for chunk in response.content.iter_chunked(64 * 1024):
+                            buffer.write(chunk)
+                            if max_bytes is not None and buffer.tell() > max_bytes:
+                                raise FileTooLargeError(f"File exceeds the limit of {max_bytes} bytes")
+                        return buffer.getvalue()
                     else:
                         logger.error(f"Failed to download file: {response.status}")
                         return None
+        except FileTooLargeError:
+            raise
         except Exception as e:
             logger.error(f"Error downloading file: {e}")
             return None
     
     @staticmethod
-    def process_image(image_data: bytes, mime_type: str) -> Optional[str]:
-        """Process image and return base64 encoded data URL"""
+    def select_photo_size(photo_sizes: List[Any], max_side: int) -> Any:
+        """Pick the smallest photo size whose longer side reaches max_side, else the largest"""
+        ordered = sorted(photo_sizes, key=lambda size: size.width * size.height)
+        for size in ordered:
+            if max(size.width, size.height) >= max_side:
+                return size
+        return ordered[-1]
+    
+    @staticmethod
+    def process_image(image_data: bytes, mime_type: str) -> Optional[Attachment]:
+        """Process image and return it as a JPEG attachment"""
         try:
+            from PIL import Image
+            
             # Validate and optimize image
             image = Image.open(io.BytesIO(image_data))
             
@@ -35,27 +98,26 @@ class FileProcessor:
             if image.mode != 'RGB':
                 image = image.convert('RGB')
             
-            # Resize if too large (max 1024x1024 for API efficiency)
-            if image.width > 1024 or image.height > 1024:
-                image.thumbnail((1024, 1024), Image.Resampling.LANCZOS)
+            # Resize if too large (max IMAGE_MAX_SIDE for API efficiency)
+            max_side = Config.IMAGE_MAX_SIDE
+            if image.width > max_side or image.height > max_side:
+                image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
             
             # Convert back to bytes
             output = io.BytesIO()
             image.save(output, format='JPEG', quality=85)
-            processed_data = output.getvalue()
-            
-            # Encode as base64
-            base64_data = base64.b64encode(processed_data).decode('utf-8')
-            return f"data:image/jpeg;base64,{base64_data}"
+            return Attachment(output.getvalue(), "image/jpeg")
         
         except Exception as e:
             logger.error(f"Error processing image: {e}")
             return None
     
     @staticmethod
-    def process_pdf(pdf_data: bytes) -> Optional[str]:
-        """Process PDF and return base64 encoded data URL"""
+    def process_pdf(pdf_data: bytes) -> Optional[Attachment]:
+        """Validate PDF and return it as an attachment"""
         try:
+            import PyPDF2
+            
             # Validate PDF
             pdf_reader = PyPDF2.PdfReader(io.BytesIO(pdf_data))
             
@@ -64,9 +126,7 @@ class FileProcessor:
                 logger.error("PDF has no pages")
                 return None
             
-            # Encode as base64
-            base64_data = base64.b64encode(pdf_data).decode('utf-8')
-            return f"data:application/pdf;base64,{base64_data}"
+            return Attachment(pdf_data, "application/pdf")
         
         except Exception as e:
             logger.error(f"Error processing PDF: {e}")
@@ -85,6 +145,7 @@ class MessageFormatter:
 🔄 /resetprompt - Сбросить системный промпт
 📝 /getprompt - Показать текущий системный промпт
 🗑️ /resetcontext - Очистить контекст чата
+⏹ /cancel - Отменить текущий запрос
 🤖 /model - Выбрать модель ИИ
 👤 /profile - Посмотреть профиль и лимиты
 ⭐️ /upgrade - Обновиться до Plus тарифа"""
@@ -101,6 +162,11 @@ class MessageFormatter:
 📈 Осталось сообщений в месяце: {profile['monthly_remaining']}
 🤖 Текущая модель: {profile['current_model']}"""
         
+        if profile.get('daily_tokens_remaining') is not None:
+            message += f"\n🔢 Осталось токенов сегодня: {max(profile['daily_tokens_remaining'], 0)}"
+        if profile.get('monthly_tokens_remaining') is not None:
+            message += f"\n🔢 Осталось токенов в месяце: {max(profile['monthly_tokens_remaining'], 0)}"
+        
         if profile.get('subscription_end_date'):
             from datetime import datetime
             end_date = datetime.fromisoformat(profile['subscription_end_date'].replace('Z', '+00:00'))